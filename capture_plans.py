@@ -1,23 +1,54 @@
 from scipy.spatial.transform import Rotation
-from picamera2 import Picamera2
 import numpy as np
 import cv2
 import time
 import sys
 import select
-import board
-import neopixel
 import os
 import yaml
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading
+from debug_writer import (
+    DEBUG_LEVELS,
+    start_debug_writer,
+    stop_debug_writer,
+    debug_enabled,
+    queue_debug_image,
+    queue_contour_image
+)
+from reconstruct import reconstruct_views, projection_matrix
+from triangulation import (
+    max_reprojection_error,
+    create_projection_matrices,
+    LED_DTYPE,
+    plan_to_records,
+    plan_to_array,
+    load_plan,
+    merge_by_id,
+    triangulate_plans,
+    split_outliers
+)
+from recorder import start_recording, record_frame, finish_recording, load_recording, load_frame
 
-# NeoPixel setup
-pixel_pin = board.D18
 num_pixels = 40  # We have 40 LEDs
-pixels = neopixel.NeoPixel(
-    pixel_pin, num_pixels, auto_write=False # Set to False to control when to write to the strip (with pixels.show)
-)
+# Made in setup_pixels, so this file can be imported without the LEDs (for replay)
+pixels = None
+
+# NeoPixel setup
+def setup_pixels():
+    global pixels
+    import board
+    import neopixel
+    pixel_pin = board.D18
+    pixels = neopixel.NeoPixel(
+        pixel_pin, num_pixels, auto_write=False # Set to False to control when to write to the strip (with pixels.show)
+    )
+    return pixels
 
 def setup_camera():
+    # Only import the camera when it is used, it is not there when replaying
+    from picamera2 import Picamera2
     picam2 = Picamera2()
     preview_config = picam2.create_preview_configuration(
         main={"size": (4608, 2592)},
@@ -27,116 +58,490 @@ def setup_camera():
     picam2.start()
     return picam2
 
-# Takes a image frame in BGR format,
-# index number of the LED,
-# name of the angle (alpha or beta)
-def detect_led_position(frame, i, angle_name):
-    # Convert image from BGR to HSV
-    # HSV should be better for detecting specific colors like blue
-    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
-    # Define the blue color range that want to find
-    # Values are in HSV
-    lower_blue = np.array([100, 150, 100])
-    upper_blue = np.array([130, 255, 255])
-
-    # Creates a black and white mask where white pixels are blue in the original image
-    mask = cv2.inRange(hsv, lower_blue, upper_blue)
-
-    # Mabye move this, so it only runs twice
-    # Make folders to save debug images
-    mask_folder = os.path.join('data', f'{angle_name}_mask')
-    contour_folder = os.path.join('data', f'{angle_name}_contours')
-    if not os.path.exists(mask_folder):
-        os.makedirs(mask_folder)
-    if not os.path.exists(contour_folder):
-        os.makedirs(contour_folder)
+# Define the blue color range that want to find
+# Values are in HSV
+lower_blue = np.array([100, 150, 100])
+upper_blue = np.array([130, 255, 255])
 
-    # Save the black and white mask image for this LED
-    mask_path = os.path.join(mask_folder, f'led_{i}_mask.jpg')
-    cv2.imwrite(mask_path, mask)
+# How much smaller the frame is when searching for the LED (4608x2592 -> 576x324)
+# and how many full resolution pixels to add around the LED when refining its center
+detect_scale = 8
+roi_padding = 24
 
+# Creates a black and white mask where white pixels are blue in the RGB image
+# The camera gives 4 channel frames ([R, G, B, 255] per pixel), only the first 3 are used
+def blue_mask(frame):
+    # Convert image from RGB to HSV
+    # HSV should be better for detecting specific colors like blue
+    hsv = cv2.cvtColor(np.ascontiguousarray(frame[:, :, :3]), cv2.COLOR_RGB2HSV)
+    return cv2.inRange(hsv, lower_blue, upper_blue)
+
+# Makes the frame scale times smaller by keeping the brightest value of every scale x scale block
+# (resizing averages the block, so a LED only a few pixels wide fades out and is missed)
+# The rows are done first, with one max over the scale rows of each block, then the columns
+def max_pool(frame, scale):
+    height = frame.shape[0] // scale
+    width = frame.shape[1] // scale
+    rows = frame[:height * scale, :width * scale].reshape(height, scale, -1).max(axis=1)
+    blocks = rows.reshape(height, width, scale, -1)
+    small = blocks[:, :, 0].copy()
+    for k in range(1, scale):
+        np.maximum(small, blocks[:, :, k], out=small)
+    return small
+
+# Finds the biggest white area in a mask, should be the LED
+# (however the LED appears white in the mask, probably due to the camera)
+def largest_contour(mask):
     # Find the outlines (contours) of white areas in the mask
     # cv2.RETR_EXTERNAL finds only the outermost contours, shuld ignore any holes inside objects
     # cv2.CHAIN_APPROX_SIMPLE compresses the contours to save memory by only storing their corner points
     contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    return max(contours, key=cv2.contourArea)
+
+# Takes a image frame in RGB format (straight from the camera),
+# index number of the LED,
+# name of the angle (alpha or beta)
+# and the debug writer (None to not save debug images)
+def detect_led_position(frame, i, angle_name, debug=None):
+    height, width = frame.shape[:2]
+
+    # Coarse step: find the LED in a small copy of the frame
+    # This is 64 times fewer pixels to convert to HSV than the full frame,
+    # and only the small frame and the ROI are converted, never the full frame
+    small_mask = blue_mask(max_pool(frame, detect_scale))
+
+    # Save the black and white mask image for this LED (in the background)
+    queue_debug_image(debug, os.path.join('data', f'{angle_name}_mask', f'led_{i}_mask.jpg'), small_mask)
+
+    coarse = largest_contour(small_mask)
+    if coarse is None:
+        # Return None if no LED was found (rally bad)
+        return None
+
+    # Fine step: only look at a small full resolution area (ROI) around the coarse LED
+    x, y, w, h = cv2.boundingRect(coarse)
+    x0 = max(x * detect_scale - roi_padding, 0)
+    y0 = max(y * detect_scale - roi_padding, 0)
+    x1 = min((x + w) * detect_scale + roi_padding, width)
+    y1 = min((y + h) * detect_scale + roi_padding, height)
+    roi = frame[y0:y1, x0:x1]
+
+    largest = largest_contour(blue_mask(roi))
+    if largest is None:
+        return None
+
+    # Calculate the center point of this area
+    M = cv2.moments(largest)
+
+    # Lets not divide by zero
+    if M["m00"] == 0:
+        return None
+
+    # Get the x,y coordinates of the LED center
+    # Starts from the top-left corner of the image, so add the ROI offset back
+
+    # Gets the sum of the x and y coordinates of all pixels in the contour
+    # Divides by the number of pixels to get the average (center) position
+    # Keep the decimals, sub-pixel positions gives better triangulation
+    cx = x0 + M["m10"] / M["m00"]
+    cy = y0 + M["m01"] / M["m00"]
+
+    # Save the debug image with the outline and center point
+    # The writer thread draws on its own copy, so the capture doesn't wait for it
+    contour_path = os.path.join('data', f'{angle_name}_contours', f'led_{i}_contour.jpg')
+    queue_contour_image(debug, contour_path, frame, largest, (x0, y0), (cx, cy), rgb=True)
+
+    # Return the LED position
+    return (cx, cy)
+
+# How much brighter than the dark frame a pixel must be to be part of the LED
+difference_threshold = 40
+
+# The channel the difference is taken on, the LEDs are lit blue
+# In grayscale blue only counts 0.114, so a fully lit blue LED hardly gets brighter than the threshold
+# (the camera and recordings give [R, G, B, 255] pixels, older recordings [R, G, B], blue is 2 in both)
+difference_channel = 2
+
+# Makes the reference for the difference detector from a frame with all LEDs off
+# The blue channel of the dark frame is kept at full size and at the small detection size
+def make_dark_reference(dark_rgb):
+    return {
+        "dark": np.ascontiguousarray(dark_rgb[:, :, difference_channel]),
+        "dark_small": np.ascontiguousarray(max_pool(dark_rgb, detect_scale)[:, :, difference_channel]),
+        "shape": dark_rgb.shape,
+        # Work buffers, one set per detection thread
+        "buffers": threading.local()
+    }
+
+# Gets the work buffers for this thread, they are only made the first time
+# so there is no allocation for each LED
+# They are sized from the dark frame, so every frame must have the same shape (and channels) as it
+def reference_buffers(reference, frame):
+    if frame.shape != reference["shape"]:
+        raise ValueError(f"Frame is {frame.shape} but the dark frame was {reference['shape']}")
+    buffers = reference["buffers"]
+    if not hasattr(buffers, "diff"):
+        buffers.small_diff = np.empty_like(reference["dark_small"])
+        buffers.small_mask = np.empty_like(reference["dark_small"])
+        buffers.diff = np.empty_like(reference["dark"])
+    return buffers
+
+# Takes a image frame in RGB format (straight from the camera, 3 or 4 channels),
+# index number of the LED, name of the angle,
+# the dark reference and the debug writer
+# Finds the LED as the area that got brighter than the dark frame,
+# so it doesn't matter what color the room light is
+def detect_led_difference(frame, i, angle_name, reference, debug=None):
+    b = reference_buffers(reference, frame)
+    height, width = frame.shape[:2]
+
+    # Coarse step: difference between the small frame and the small dark frame
+    # Both are max pooled, so a LED a few pixels wide isn't averaged away
+    # cv2.subtract stops at 0, so only pixels that got brighter are kept
+    # (the results are the returned arrays, cv2 makes a new one if a buffer doesn't fit)
+    small = max_pool(frame, detect_scale)[:, :, difference_channel]
+    small_diff = cv2.subtract(np.ascontiguousarray(small), reference["dark_small"], dst=b.small_diff)
+    _, small_mask = cv2.threshold(small_diff, difference_threshold, 255, cv2.THRESH_BINARY, dst=b.small_mask)
+
+    # The buffer is used again for the next LED, so the debug writer needs its own copy
+    if debug_enabled(debug):
+        queue_debug_image(debug, os.path.join('data', f'{angle_name}_mask', f'led_{i}_mask.jpg'), small_mask.copy())
+
+    coarse = largest_contour(small_mask)
+    if coarse is None:
+        return None
+
+    # Fine step: difference in a full resolution area (ROI) around the LED
+    # The result is written into the same place in the full size buffer
+    x, y, w, h = cv2.boundingRect(coarse)
+    x0 = max(x * detect_scale - roi_padding, 0)
+    y0 = max(y * detect_scale - roi_padding, 0)
+    x1 = min((x + w) * detect_scale + roi_padding, width)
+    y1 = min((y + h) * detect_scale + roi_padding, height)
+    roi = np.ascontiguousarray(frame[y0:y1, x0:x1, difference_channel])
+    roi_diff = cv2.subtract(roi, reference["dark"][y0:y1, x0:x1], dst=b.diff[y0:y1, x0:x1])
+    # Set everything below the threshold to 0, but keep the brightness of the LED pixels
+    _, roi_diff = cv2.threshold(roi_diff, difference_threshold, 255, cv2.THRESH_TOZERO, dst=roi_diff)
+
+    # Brightness weighted center, brighter pixels count more
+    M = cv2.moments(roi_diff)
+    if M["m00"] == 0:
+        return None
+    cx = x0 + M["m10"] / M["m00"]
+    cy = y0 + M["m01"] / M["m00"]
+
+    largest = largest_contour(roi_diff)
+    if largest is not None:
+        contour_path = os.path.join('data', f'{angle_name}_contours', f'led_{i}_contour.jpg')
+        queue_contour_image(debug, contour_path, frame, largest, (x0, y0), (cx, cy), rgb=True)
+
+    return (cx, cy)
+
+# How many frames to wait for one that was exposed after the LEDs changed
+max_sync_frames = 10
+# Number of detection threads, and how many captured frames can wait for them
+# (every full resolution frame is 36 MB, so don't let them pile up)
+detect_workers = 3
+max_frames_in_flight = 4
+
+# The clock libcamera uses for the SensorTimestamp metadata
+def camera_clock_ns():
+    return time.clock_gettime_ns(time.CLOCK_BOOTTIME)
+
+# Captures the first frame where the exposure started after changed_at (in ns)
+# This replaces the fixed sleeps, we know from the metadata when the frame was exposed
+# Returns the RGB frame and its metadata
+def capture_frame_after(camera, changed_at):
+    for _ in range(max_sync_frames):
+        request = camera.capture_request()
+        try:
+            metadata = request.get_metadata()
+            # SensorTimestamp is when the frame was read out,
+            # so the exposure started ExposureTime (in us) before that
+            exposure_start = metadata["SensorTimestamp"] - metadata["ExposureTime"] * 1000
+            if exposure_start >= changed_at:
+                return request.make_array("main"), metadata
+        finally:
+            request.release()
+
+    # No good frame in time (should not happen), just use the next one
+    print(f"Warning: no frame exposed after the LED change in {max_sync_frames} frames")
+    request = camera.capture_request()
+    try:
+        return request.make_array("main"), request.get_metadata()
+    finally:
+        request.release()
+
+# Writes the LEDs to the strip and captures the first frame that shows them
+def show_and_capture(camera):
+    pixels.show()
+    return capture_frame_after(camera, camera_clock_ns())
+
+# Runs in the detection threads
+# Takes the RGB frame from the camera, the LED index, the angle name
+# and the dark reference (None to use the blue color detector)
+def process_led_frame(frameRGB, i, angle_name, reference, debug):
+    start = time.perf_counter()
+    if reference is not None:
+        position = detect_led_difference(frameRGB, i, angle_name, reference, debug)
+    else:
+        position = detect_led_position(frameRGB, i, angle_name, debug)
+    detect_time = time.perf_counter() - start
+    return position, detect_time
+
+# Takes the camera object, the angle name (alpha or beta),
+# the debug level for the debug images
+# the detector ("color" for the blue color range, "difference" for the dark frame difference)
+# and if the frames should be recorded for replay
+# led_ids can be a list of LEDs to capture (default is all of them),
+# and save=False doesn't write the plan files (when only some LEDs are captured again)
+# The main thread switches the LEDs and captures frames,
+# while the detection threads work on the frames that are already captured
+def capture_plan(camera, angle_name, debug_level="thumbnails", detector="color", record=False,
+                 led_ids=None, save=True):
+    if led_ids is None:
+        led_ids = range(num_pixels)
+
+    debug = start_debug_writer(debug_level)
+    recorder = start_recording(angle_name, "single", num_pixels) if record else None
 
-    if contours:
-        # Find the biggest white area, should be the LED (however the LED appears white in the mask, probably due to the camera)
-        largest = max(contours, key=cv2.contourArea)
-        # Calculate the center point of this area
-        M = cv2.moments(largest)
-
-        # Lets not divide by zero
-        if M["m00"] != 0:
-            # Get the x,y coordinates of the LED center
-            # Starts from the top-left corner of the image
-
-            # Gets the sum of the x and y coordinates of all pixels in the contour
-            # Divides by the number of pixels to get the average (center) position
-            cx = int(M["m10"] / M["m00"])
-            cy = int(M["m01"] / M["m00"])
-
-            # Draw the outline and center point on a copy of the original image to debug
-            contour_image = frame.copy()
-            cv2.drawContours(contour_image, [largest], -1, (0, 0, 255), 2)
-            cv2.circle(contour_image, (cx, cy), 5, (0, 0, 255), -1)
-
-            # Save the debug image
-            contour_path = os.path.join(contour_folder, f'led_{i}_contour.jpg')
-            cv2.imwrite(contour_path, contour_image)
-
-            # Return the LED position
-            return (cx, cy)
-    # Return None if no LED was found (rally bad)
-    return None
-
-# Takes the camera object and the angle name (alpha or beta)
-def capture_plan(camera, angle_name):
     # First turn off all LEDs
     pixels.fill((0, 0, 0))
-    pixels.show()
-    time.sleep(0.2)
+    pixels.brightness = 1.0
+    dark_frame, dark_metadata = show_and_capture(camera)
+    record_frame(recorder, dark_frame, dark_metadata, pattern="dark")
+
+    # One dark frame for the whole angle
+    reference = make_dark_reference(dark_frame) if detector == "difference" else None
 
     led_positions = []
-    # frameRGB = None
-    # Use BGR so the color of the image is correct
-    frameBGR = None
+    frameRGB = None
+    # Time spent in detect_led_position for each LED
+    detect_times = []
+
+    # Frames waiting for detection, with their LED index and metadata
+    pending = []
+
+    def collect(job):
+        i, metadata, future = job
+        position, detect_time = future.result()
+        detect_times.append(detect_time)
+        print(f"LED {i}: detection took {detect_time * 1000:.1f} ms "
+              f"(exposure {metadata.get('ExposureTime', 0) / 1000:.1f} ms)")
+        if position:
+            # Store LED ID and x,y coordinates
+            led_positions.append((i, position[0], position[1]))
 
-    for i in range(num_pixels):
-        # Just to double-check all LEDs are off
+    with ThreadPoolExecutor(max_workers=detect_workers) as pool:
+        previous = None
+        for i in led_ids:
+            i = int(i)
+            # Turn off the last LED and turn on the next one with blue color (in GBR format..)
+            # in the same write to the strip
+            if previous is not None:
+                pixels[previous] = (0, 0, 0)
+            pixels[i] = (0, 255, 0)  # Blue in GBR format (WHY!?? NEOPIXEL WHY!?!???)
+            previous = i
+
+            # Capture the frame and give it to a detection thread
+            frameRGB, metadata = show_and_capture(camera)
+            record_frame(recorder, frameRGB, metadata, led=i)
+            pending.append((i, metadata, pool.submit(process_led_frame, frameRGB, i, angle_name, reference, debug)))
+
+            # Wait for the oldest frame if too many are waiting
+            if len(pending) >= max_frames_in_flight:
+                collect(pending.pop(0))
+
+        # Turn off the last LED
         pixels.fill((0, 0, 0))
         pixels.show()
-        time.sleep(0.2)
 
-        # Turn on single LED with blue color (in GBR format..)
-        pixels[i] = (0, 255, 0)  # Blue in GBR format (WHY!?? NEOPIXEL WHY!?!???)
-        pixels.brightness = 1.0
-        pixels.show()
-        time.sleep(0.3)
+        for job in pending:
+            collect(job)
 
-        # Capture and process frame
-        frameRGB = camera.capture_array()
-        frameBGR = cv2.cvtColor(frameRGB, cv2.COLOR_RGB2BGR)
-        position = detect_led_position(frameBGR, i, angle_name)
+    # Wait for the last debug images
+    stop_debug_writer(debug)
+    finish_recording(recorder)
 
-        # Turn off LED after capture
-        pixels[i] = (0, 0, 0)
-        pixels.show()
+    if detect_times:
+        print(f"Average detection time: {np.mean(detect_times) * 1000:.1f} ms per LED")
 
-        if position:
-            # Store LED ID and x,y coordinates
-            led_positions.append((i, position[0], position[1]))
-            cv2.circle(frameBGR, position, 5, (0, 0, 255), -1)
+    led_positions.sort()
+    if save:
+        save_plan(angle_name, led_positions, frameRGB)
+    return led_positions
 
-    # Save the last frame of the angle in data folder
-    # to use in view_plans.py
-    if frameBGR is not None:
+# Saves the found LEDs of an angle in the data folder
+# The frame (RGB) is saved with all found LEDs marked, to use in view_plans.py
+def save_plan(angle_name, led_positions, frameRGB):
+    if frameRGB is not None:
+        frameBGR = cv2.cvtColor(frameRGB, cv2.COLOR_RGB2BGR)
+        for _, x, y in led_positions:
+            cv2.circle(frameBGR, (int(x), int(y)), 5, (0, 0, 255), -1)
         cv2.imwrite(f"data/plan_{angle_name}.jpg", frameBGR)
 
     # Save coordinates in data folder
     np.save(f"data/plan_{angle_name}.npy", np.array(led_positions))
 
+# Gray code of a number, neighbour codes only differ by one bit
+# so a LED on the edge of two bits is less likely to get a wrong ID
+def gray_encode(n):
+    return n ^ (n >> 1)
+
+# Turns Gray codes back into normal numbers (works on numpy arrays too)
+def gray_decode(g):
+    n = g.copy() if isinstance(g, np.ndarray) else g
+    shift = g >> 1
+    while np.any(shift):
+        n = n ^ shift
+        shift = shift >> 1
+    return n
+
+# LED i gets the Gray code of i + 1, code 0 (never lit) is not used by any LED
+# so glare or a reflection that is on in the all-on frame but off in every bit frame isn't taken as LED 0
+def led_code(i):
+    return gray_encode(i + 1)
+
+# Number of bit frames needed to give every LED its own code (codes 1 to num_leds)
+def binary_frame_count(num_leds):
+    return max(1, int(np.ceil(np.log2(num_leds + 1))))
+
+# Takes the all-off frame, the all-on frame and the bit frames
+# (only the blue channel, since the LEDs are blue)
+# and finds the LED ID of every lit blob
+def decode_binary_frames(off_frame, on_frame, bit_frames, num_leds, threshold=40, min_area=4):
+    # How much brighter each pixel gets when all LEDs are on
+    on_diff = cv2.subtract(on_frame, off_frame)
+    mask = (on_diff > threshold).astype(np.uint8)
+
+    # Every white area in the mask is a LED (label 0 is the background)
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask)
+    if num_labels <= 1:
+        return []
+
+    labels_flat = labels.ravel()
+    areas = np.bincount(labels_flat, minlength=num_labels).astype(np.float32)
+    areas[areas == 0] = 1
+
+    # A pixel is "on" in a bit frame if it got at least half as bright as in the all-on frame
+    # Then every blob gets the bit that most of its pixels agree on
+    half_on = on_diff.astype(np.int16) // 2
+    codes = np.zeros(num_labels, dtype=np.int64)
+    for bit, frame in enumerate(bit_frames):
+        bit_diff = cv2.subtract(frame, off_frame).astype(np.int16)
+        is_on = ((bit_diff > half_on) & (mask > 0)).ravel()
+        votes = np.bincount(labels_flat, weights=is_on, minlength=num_labels)
+        codes |= (votes / areas > 0.5).astype(np.int64) << bit
+
+    # Code 0 means the blob was off in every bit frame, so it isn't a LED
+    led_ids = gray_decode(codes) - 1
+
+    # If two blobs decode to the same LED, keep the biggest one
+    best = {}
+    for label in range(1, num_labels):
+        led_id = int(led_ids[label])
+        area = stats[label, cv2.CC_STAT_AREA]
+        if area < min_area or led_id < 0 or led_id >= num_leds:
+            continue
+        if led_id not in best or area > best[led_id][0]:
+            best[led_id] = (area, centroids[label])
+
+    return [(led_id, float(best[led_id][1][0]), float(best[led_id][1][1])) for led_id in sorted(best)]
+
+# Same as capture_plan, but lights all LEDs at once with a Gray code pattern
+# Only needs ceil(log2(N)) + 2 frames instead of N frames
+def capture_plan_binary(camera, angle_name, debug_level="thumbnails", record=False):
+    num_bits = binary_frame_count(num_pixels)
+    codes = [led_code(i) for i in range(num_pixels)]
+    debug = start_debug_writer(debug_level)
+    recorder = start_recording(angle_name, "binary", num_pixels) if record else None
+
+    # Reference frames, everything off and everything on
+    pixels.fill((0, 0, 0))
+    frameRGB, metadata = show_and_capture(camera)
+    record_frame(recorder, frameRGB, metadata, pattern="dark")
+    off_frame = frameRGB[:, :, 2].copy() # Blue channel of the RGB frame
+
+    pixels.fill((0, 255, 0)) # Blue in GBR format
+    frameRGB, metadata = show_and_capture(camera)
+    record_frame(recorder, frameRGB, metadata, pattern="on")
+    on_frame = frameRGB[:, :, 2].copy()
+    on_frameRGB = frameRGB
+
+    # One frame per bit, a LED is on if its bit is set in its Gray code
+    bit_frames = []
+    for bit in range(num_bits):
+        for i in range(num_pixels):
+            pixels[i] = (0, 255, 0) if (codes[i] >> bit) & 1 else (0, 0, 0)
+        frameRGB, metadata = show_and_capture(camera)
+        record_frame(recorder, frameRGB, metadata, pattern=f"bit {bit}")
+        bit_frames.append(frameRGB[:, :, 2].copy())
+        queue_debug_image(debug, os.path.join('data', f'{angle_name}_mask', f'bit_{bit}.jpg'), bit_frames[-1])
+
+    pixels.fill((0, 0, 0))
+    pixels.show()
+    stop_debug_writer(debug)
+    finish_recording(recorder)
+
+    led_positions = decode_binary_frames(off_frame, on_frame, bit_frames, num_pixels)
+    print(f"Decoded {len(led_positions)} LEDs from {num_bits + 2} frames")
+
+    # Save the all-on frame with the found LEDs, same format as capture_plan
+    save_plan(angle_name, led_positions, on_frameRGB)
+    return led_positions
+
+# Dark references made in this process, so each replay process only makes it once
+replay_references = {}
+
+# Runs in the replay processes
+# Loads a recorded frame and finds the LED with the same code as a live capture
+def replay_led_frame(path, i, angle_name, dark_path, detector):
+    frameRGB = load_frame(path)
+    reference = None
+    if detector == "difference":
+        if dark_path not in replay_references:
+            replay_references[dark_path] = make_dark_reference(load_frame(dark_path))
+        reference = replay_references[dark_path]
+    position, detect_time = process_led_frame(frameRGB, i, angle_name, reference, None)
+    return i, position, detect_time
+
+# Runs in the replay processes, only the blue channel is needed for binary mode
+def replay_blue_channel(path):
+    return load_frame(path)[:, :, 2].copy()
+
+# Runs detection on a recorded angle instead of the camera
+# The frames are spread over a process pool, so this runs as fast as the CPU allows
+# Writes the same plan files as capture_plan and capture_plan_binary
+def replay_plan(angle_name, detector="color", workers=None):
+    recording = load_recording(angle_name)
+    frames = recording["frames"]
+    by_pattern = {frame["pattern"]: frame["path"] for frame in frames if frame["pattern"]}
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if recording["mode"] == "binary":
+            bit_paths = [by_pattern[f"bit {bit}"] for bit in range(binary_frame_count(recording["num_leds"]))]
+            off_frame, on_frame, *bit_frames = pool.map(replay_blue_channel, [by_pattern["dark"], by_pattern["on"]] + bit_paths)
+            led_positions = decode_binary_frames(off_frame, on_frame, bit_frames, recording["num_leds"])
+            last_path = by_pattern["on"]
+        else:
+            led_frames = [frame for frame in frames if frame["led"] is not None]
+            results = pool.map(replay_led_frame,
+                               [frame["path"] for frame in led_frames],
+                               [frame["led"] for frame in led_frames],
+                               [angle_name] * len(led_frames),
+                               [by_pattern["dark"]] * len(led_frames),
+                               [detector] * len(led_frames))
+            led_positions = [(i, position[0], position[1]) for i, position, _ in results if position]
+            last_path = led_frames[-1]["path"] if led_frames else None
+
+    total_time = time.perf_counter() - start
+    print(f"Replayed {len(frames)} frames of {angle_name} in {total_time:.2f} s "
+          f"({len(frames) / total_time:.1f} frames/s), found {len(led_positions)} LEDs")
+
+    save_plan(angle_name, led_positions, load_frame(last_path) if last_path else None)
     return led_positions
 
 def load_calibration():
@@ -146,45 +551,246 @@ def load_calibration():
     dist = np.array(calibration_data['dist_coeff'])
     return mtx, dist
 
-def create_projection_matrices(mtx, dist, R1, t1, R2, t2):
-    # P = K[R|t] where K is the camera matrix
-    # R1 is identity matrix (no rotation) and t1 is zero (at origin)
-    P1 = np.dot(mtx, np.hstack((R1, t1)))
+def parse_args():
+    parser = argparse.ArgumentParser(description="Capture LED positions from two camera angles")
+    # single: one LED per frame (slow but simple)
+    # binary: all LEDs at once with Gray code patterns, only log2(N) + 2 frames per angle
+    parser.add_argument("--mode", choices=["single", "binary"], default="single",
+                        help="How the LEDs are lit during capture")
+    parser.add_argument("--debug-level", choices=DEBUG_LEVELS, default="thumbnails",
+                        help="Debug images to save for each LED (written in the background)")
+    # color: the blue color range, difference: brighter than a frame with all LEDs off
+    # (binary mode always uses the difference)
+    parser.add_argument("--detector", choices=["color", "difference"], default="color",
+                        help="How a single LED is found in the frame")
+    parser.add_argument("--record", action="store_true",
+                        help="Save the captured frames to data/recordings for --replay")
+    parser.add_argument("--replay", action="store_true",
+                        help="Run detection on recorded frames instead of the camera and LEDs")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes for --replay (default is one per CPU)")
+    parser.add_argument("--views", type=int, default=2, choices=range(2, len(angle_names) + 1),
+                        help="Number of camera positions around the tree")
+    parser.add_argument("--estimate-poses", action="store_true",
+                        help="Find the camera positions from the LEDs (always on with more than 2 views)")
+    parser.add_argument("--baseline", type=float, default=2000.0,
+                        help="Distance (mm) the camera is moved between the first two positions, "
+                             "it sets the scale of the 3D positions (measure it)")
+    parser.add_argument("--max-error", type=float, default=max_reprojection_error,
+                        help="Reprojection error (px) above which a LED is flagged for re-capture")
+    parser.add_argument("--repair", choices=angle_names,
+                        help="Only capture the missing and flagged LEDs again, from this camera position")
+    return parser.parse_args()
+
+# Names of the camera positions, the plans are saved as data/plan_{name}.npy
+angle_names = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+
+# Waits for the user to press enter and blinks the LEDs red while waiting
+def wait_for_camera_move(message):
+    print(f"\n{message}")
+    print("Press Enter when camera is moved")
+    while True:
+        # Check if there's input available
+        if select.select([sys.stdin], [], [], 0.2)[0]:
+            input()
+            break
+
+        # Blink LED while waiting
+        pixels.fill((0, 0, 255))
+        pixels.show()
+        time.sleep(0.25)
+        pixels.fill((0, 0, 0))
+        pixels.show()
+        time.sleep(0.25)
+
+    pixels.fill((0, 0, 0))
+    pixels.show()
+    time.sleep(0.1)
+
+# Captures all angles with the camera and the LEDs
+# Returns a list with the positions of each angle, or None if the capture was interrupted
+def capture_views(args, names):
+    setup_pixels()
+    camera = setup_camera()
 
-    # R2 is 15-degree rotation and t2 is translation in X direction
-    P2 = np.dot(mtx, np.hstack((R2, t2)))
+    # Captures one angle with the chosen mode
+    def capture(angle_name):
+        if args.mode == "binary":
+            return capture_plan_binary(camera, angle_name, args.debug_level, args.record)
+        return capture_plan(camera, angle_name, args.debug_level, args.detector, args.record)
 
-    # Return both projection matrices
-    return P1, P2
+    try:
+        # First capture (alpha plan - 0 degrees)
+        print("Capturing alpha plan (0 degrees)")
+        print("Please ensure the camera is in the initial position")
+        input("Press Enter to continue...")
+        positions = [capture(names[0])]
+
+        for angle_name in names[1:]:
+            if len(names) == 2 and not args.estimate_poses:
+                # The two angle setup has fixed camera positions
+                wait_for_camera_move(f"Please move the camera {args.baseline:.0f} mm to the right "
+                                     "and rotate it 15 degrees")
+                print("Capturing beta plan (15 degrees)")
+            elif angle_name == names[1]:
+                # The first move sets the scale, so it has to be measured
+                wait_for_camera_move(f"Please move the camera exactly {args.baseline:.0f} mm around the tree "
+                                     "(measure it, this sets the scale)")
+                print(f"Capturing {angle_name} plan")
+            else:
+                # The positions are found from the LEDs, so they only have to overlap
+                wait_for_camera_move("Please move the camera around the tree to the next position")
+                print(f"Capturing {angle_name} plan")
+            positions.append(capture(angle_name))
+        return positions
 
-# See https://stackoverflow.com/questions/55740284/how-to-triangulate-a-point-in-3d-space-given-coordinate-points-in-2-image-and-e
-def triangulate_points(points1, points2, P1, P2, mtx, dist):
-    # Undistort the points using camera calibration parameters
-    # This should remove lens distortion effects from the 2D point coordinates
-    points1_undist = cv2.undistortPoints(points1.reshape(-1, 1, 2), mtx, dist)
-    points2_undist = cv2.undistortPoints(points2.reshape(-1, 1, 2), mtx, dist)
+    except KeyboardInterrupt:
+        print("\nCapture interrupted")
+        return None
 
-    # OpenCV's triangulatePoints function can find the 3D coordinates
-    # The function returns a 4xN array of homogeneous coordinates (X,Y,Z,W) <-- THIS IS 4D!!
-    points_4d = cv2.triangulatePoints(P1, P2, 
-                                    points1_undist.reshape(2, -1),
-                                    points2_undist.reshape(2, -1))
+    finally:
+        # Clean up
+        pixels.fill((0, 0, 0))
+        pixels.show()
+        camera.stop()
 
-    # Convert from homogeneous to "normal" 3D coordinates
-    # Take first 3 rows (X,Y,Z) and divide by 4th row (W)
-    points_3d = points_4d[:3] / points_4d[3]
+# Writes the good 3D LED positions to data/led_3d_coordinates.txt (X, Y, Z in mm)
+# All LEDs with their reprojection errors are saved in data/led_3d_results.npy,
+# the ones with a too high error are not written to the text file but listed for re-capture
+def write_3d_positions(leds, max_error=max_reprojection_error):
+    np.save('data/led_3d_results.npy', leds)
+    good, outliers = split_outliers(leds, max_error)
+
+    with open('data/led_3d_coordinates.txt', 'w') as f:
+        f.write("LED ID, X, Y, Z\n")
+        for led in good:
+            print(f"LED {led['id']}: ({led['x']:.4f}, {led['y']:.4f}, {led['z']:.4f})")
+            f.write(f"{led['id']},{led['x']:.4f},{led['y']:.4f},{led['z']:.4f}\n")
+
+    if len(good):
+        print(f"Mean reprojection error: {np.mean(good['error']):.2f} px")
+
+    if len(outliers):
+        print(f"\nLEDs with reprojection error over {max_error} px (should be captured again):")
+        print(", ".join(f"{led['id']} ({led['error']:.1f} px)" for led in outliers))
+
+    missing_leds = np.setdiff1d(np.arange(num_pixels), leds["id"])
+    if len(missing_leds):
+        print("\nMissing LEDs (not detected in at least two views):")
+        print(missing_leds.tolist())
+
+# Saves the projection matrix of every camera position the results were made with
+# in data/camera_poses.npz, so --repair triangulates in the same coordinates
+def save_camera_poses(projections):
+    names = list(projections)
+    np.savez('data/camera_poses.npz', names=np.array(names),
+             projections=np.array([projections[name] for name in names]))
+
+# Loads the projection matrices saved with the results, {angle name: P}
+def load_camera_poses():
+    poses = np.load('data/camera_poses.npz')
+    return {str(name): P for name, P in zip(poses["names"], poses["projections"])}
+
+# Finds the camera positions and the 3D LEDs from all angles, and saves them
+def save_reconstruction(all_positions, names, mtx, dist, baseline, max_error=max_reprojection_error):
+    views = [{int(p[0]): (p[1], p[2]) for p in positions} for positions in all_positions]
+    start = time.perf_counter()
+    result = reconstruct_views(views, mtx, dist, baseline)
+    print(f"Reconstructed {len(result['leds'])} LEDs from {len(result['cameras'])} "
+          f"camera positions in {time.perf_counter() - start:.2f} s")
+
+    write_3d_positions(result["leds"], max_error)
+    save_camera_poses({names[cam]: projection_matrix(mtx, camera[:3], camera[3:6])
+                       for cam, camera in result["cameras"].items()})
+
+# Triangulates the LEDs found in both angles and saves them
+def save_3d_positions(alpha_positions, beta_positions, P1, P2, mtx, dist, max_error=max_reprojection_error):
+    leds = triangulate_plans(plan_to_records(alpha_positions), plan_to_records(beta_positions), P1, P2, mtx, dist)
+    if len(leds) == 0:
+        print("No LEDs were detected in both views/plans!")
+        return
+
+    print(f"Processing {len(leds)} LEDs detected in both views")
+    write_3d_positions(leds, max_error)
+    save_camera_poses({"alpha": P1, "beta": P2})
+
+# LEDs that should be captured again from an angle:
+# not found from this angle, or with a too high reprojection error
+def repair_targets(plan, leds, max_error=max_reprojection_error):
+    missing_here = np.setdiff1d(np.arange(num_pixels), plan["id"])
+    outliers = leds["id"][leds["error"] > max_error]
+    return np.union1d(missing_here, outliers)
+
+# Captures only the missing and bad LEDs again from the current camera position
+# The new positions are merged into the saved plan, and only those LEDs are triangulated again,
+# with the camera positions that were saved with the results (fixed or estimated)
+def repair_plan(args, angle_name, mtx, dist):
+    try:
+        poses = load_camera_poses()
+    except FileNotFoundError:
+        print("Error: No camera positions were saved with the results. Run a full capture first.")
+        return
+    if angle_name not in poses:
+        print(f"Error: The results were not made with a {angle_name} camera position "
+              f"(only {', '.join(poses)}).")
+        return
+
+    try:
+        plans = {name: load_plan(name) for name in poses}
+    except FileNotFoundError:
+        print("Error: Could not find plan data files. Run a full capture first.")
+        return
+
+    if os.path.exists('data/led_3d_results.npy'):
+        leds = np.load('data/led_3d_results.npy')
+    else:
+        leds = np.empty(0, dtype=LED_DTYPE)
+
+    targets = repair_targets(plans[angle_name], leds, args.max_error)
+    if len(targets) == 0:
+        print(f"Nothing to repair in the {angle_name} plan")
+        return
+    print(f"Capturing {len(targets)} LEDs again from the {angle_name} position: {targets.tolist()}")
+
+    setup_pixels()
+    camera = setup_camera()
+    try:
+        new_positions = capture_plan(camera, angle_name, args.debug_level, args.detector,
+                                     led_ids=targets, save=False)
+    except KeyboardInterrupt:
+        print("\nCapture interrupted")
+        return
+    finally:
+        pixels.fill((0, 0, 0))
+        pixels.show()
+        camera.stop()
 
-    # Return Nx3 array of 3D points
-    return points_3d
+    new_plan = plan_to_records(new_positions)
+    print(f"Found {len(new_plan)} of {len(targets)} LEDs")
+    plans[angle_name] = merge_by_id(plans[angle_name], new_plan)
+    np.save(f"data/plan_{angle_name}.npy", plan_to_array(plans[angle_name]))
+
+    # Only triangulate the LEDs that were found again,
+    # each one with the first other camera position that also sees it
+    changed = new_plan["id"]
+    new_leds = np.empty(0, dtype=LED_DTYPE)
+    for other in poses:
+        if other == angle_name:
+            continue
+        remaining = changed[~np.isin(changed, new_leds["id"])]
+        pair_leds = triangulate_plans(plans[angle_name][np.isin(plans[angle_name]["id"], remaining)],
+                                      plans[other][np.isin(plans[other]["id"], remaining)],
+                                      poses[angle_name], poses[other], mtx, dist)
+        new_leds = merge_by_id(new_leds, pair_leds)
+    write_3d_positions(merge_by_id(leds, new_leds), args.max_error)
 
 def main():
+    args = parse_args()
+
     # Create data folder if it doesn't exist
     if not os.path.exists('data'):
         os.makedirs('data')
 
-    # Setup camera
-    camera = setup_camera()
-
     # Load calibration
     mtx, dist = load_calibration()
 
@@ -197,107 +803,28 @@ def main():
     # Rotate 15 degrees around Y-axis to the right
     # This means you have to rotate the camera to the left to see the same view
     R2 = Rotation.from_euler('y', 15, degrees=True).as_matrix()
-    t2 = np.array([[2000], [0], [0]]) # 2000mm/2m translation in X
+    t2 = np.array([[args.baseline], [0], [0]]) # --baseline translation in X (2000mm/2m by default)
 
     # Create projection matrices
-    P1, P2 = create_projection_matrices(mtx, dist, R1, t1, R2, t2)
-
-    try:
-        # First capture (alpha plan - 0 degrees)
-        print("Capturing alpha plan (0 degrees)")
-        print("Please ensure the camera is in the initial position")
-        input("Press Enter to continue...")
-        alpha_positions = capture_plan(camera, "alpha")
-
-        # Wait for the user to press enter and blink LEDs red to indicate rotation
-        print("\nPlease rotate camera 15 degrees")
-        print("Press Enter when camera is rotated")
-        while True:
-            # Check if there's input available
-            if select.select([sys.stdin], [], [], 0.2)[0]:
-                input()
-                break
-
-            # Blink LED while waiting
-            pixels.fill((0, 0, 255))
-            pixels.show()
-            time.sleep(0.25)
-            pixels.fill((0, 0, 0))
-            pixels.show()
-            time.sleep(0.25)
-
-        pixels.fill((0, 0, 0))
-        pixels.show()
-        time.sleep(0.1)
-
-        # Second capture (beta plan - 15 degrees)
-        print("Capturing beta plan (15 degrees)")
-        beta_positions = capture_plan(camera, "beta")
-
-        # Dictionaries to store positions by LED ID
-        alpha_dict = {p[0]: (p[1], p[2]) for p in alpha_positions}
-        beta_dict = {p[0]: (p[1], p[2]) for p in beta_positions}
-
-        # Should find common LED IDs, that are detected in both views/plans
-        common_leds = set(alpha_dict.keys()) & set(beta_dict.keys())
-
-        if not common_leds:
-            print("No LEDs were detected in both views/plans!")
+    P1, P2 = create_projection_matrices(mtx, R1, t1, R2, t2)
+
+    if args.repair:
+        repair_plan(args, args.repair, mtx, dist)
+        return
+
+    names = angle_names[:args.views]
+    if args.replay:
+        # No camera or LEDs needed, the recorded frames go through the same detection
+        all_positions = [replay_plan(angle_name, args.detector, args.workers) for angle_name in names]
+    else:
+        all_positions = capture_views(args, names)
+        if all_positions is None:
             return
 
-        #  Arrays only for LEDs detected in both views/plans
-        points1 = []
-        points2 = []
-        led_ids = []
-
-        for led_id in common_leds:
-            points1.append(alpha_dict[led_id])
-            points2.append(beta_dict[led_id])
-            led_ids.append(led_id)
-
-        points1 = np.array(points1, dtype=np.float32)
-        points2 = np.array(points2, dtype=np.float32)
-
-        print(f"Processing {len(common_leds)} LEDs detected in both views")
-
-        # Triangulate 3D points
-        points_3d = triangulate_points(points1, points2, P1, P2, mtx, dist)
-
-        # Save results
-        led_positions_3d = {}
-        for i, point3d in enumerate(points_3d):
-            led_id = led_ids[i]
-            led_positions_3d[led_id] = {
-                "id": led_id,
-                "x": point3d[0],
-                "y": point3d[1],
-                "z": point3d[2]
-            }
-
-        # Save to file with world coordinates
-        # Where X, Y, Z are in mm
-        with open('data/led_3d_coordinates.txt', 'w') as f:
-            f.write("LED ID, X, Y, Z\n")
-            for led_id in sorted(led_positions_3d.keys()):
-                led = led_positions_3d[led_id]
-                print(f"LED {led['id']}: ({led['x']:.4f}, {led['y']:.4f}, {led['z']:.4f})")
-                f.write(f"{led['id']},{led['x']:.4f},{led['y']:.4f},{led['z']:.4f}\n")
-
-        # Print missing LEDs
-        all_leds = set(range(num_pixels))
-        missing_leds = all_leds - common_leds
-        if missing_leds:
-            print("\nMissing LEDs (not detected in both views):")
-            print(sorted(missing_leds))
-
-    except KeyboardInterrupt:
-        print("\nCapture interrupted")
-
-    finally:
-        # Clean up
-        pixels.fill((0, 0, 0))
-        pixels.show()
-        camera.stop()
+    if len(names) == 2 and not args.estimate_poses:
+        save_3d_positions(all_positions[0], all_positions[1], P1, P2, mtx, dist, args.max_error)
+    else:
+        save_reconstruction(all_positions, names, mtx, dist, args.baseline, args.max_error)
 
 if __name__ == "__main__":
     main()
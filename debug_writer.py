@@ -0,0 +1,134 @@
+import os
+import queue
+import threading
+import cv2
+import numpy as np
+
+# Debug levels
+# off: no debug images at all
+# thumbnails: small images, cheap to encode and write
+# full: full resolution images (slow on the SD card)
+DEBUG_LEVELS = ("off", "thumbnails", "full")
+
+# Width of the thumbnail images in pixels
+thumbnail_width = 640
+
+# Most bytes of images that can wait in the queue (a full resolution frame is 36 MB)
+max_queue_bytes = 128 * 1024 * 1024
+
+# Starts a background thread that writes debug images to disk
+# Capture puts images in a queue, and the thread does the slow JPEG encoding and writing
+# If the queue is full (max_queue images or max_bytes bytes) the image is dropped,
+# so capture never waits for the disk
+def start_debug_writer(level="thumbnails", max_queue=16, max_bytes=max_queue_bytes):
+    if level not in DEBUG_LEVELS:
+        raise ValueError(f"Unknown debug level: {level}")
+
+    writer = {
+        "level": level,
+        "queue": queue.Queue(maxsize=max_queue),
+        "max_bytes": max_bytes,
+        "queued_bytes": 0,
+        "bytes_lock": threading.Lock(),
+        "thread": None,
+        "written": 0,
+        "dropped": 0
+    }
+    if level == "off":
+        return writer
+
+    writer["thread"] = threading.Thread(target=run_debug_writer, args=(writer,), daemon=True)
+    writer["thread"].start()
+    return writer
+
+# True if the writer saves images, so callers can skip making copies for it
+def debug_enabled(writer):
+    return writer is not None and writer["thread"] is not None
+
+# Makes the image thumbnail_width wide, or returns it as it is if it is already that small
+# INTER_LINEAR only reads a few pixels for each thumbnail pixel, so it is fast enough for the capture threads
+def make_thumbnail(image):
+    if image.shape[1] <= thumbnail_width:
+        return image, 1.0
+    scale = thumbnail_width / image.shape[1]
+    height = int(image.shape[0] * scale)
+    return cv2.resize(image, (thumbnail_width, height), interpolation=cv2.INTER_LINEAR), scale
+
+# Queues a mask image
+# At the thumbnails level the thumbnail is made here, so only small images wait in the queue
+def queue_debug_image(writer, path, image):
+    if not debug_enabled(writer):
+        return
+    if writer["level"] == "thumbnails":
+        image, _ = make_thumbnail(image)
+    queue_debug_job(writer, (path, image, None, None, None, False))
+
+# Queues a contour image
+# At the thumbnails level the frame is made small first and the contour is scaled to it,
+# at the full level the frame is not copied or drawn on here, the writer thread does that
+# Set rgb to True if the frame is RGB (straight from the camera) instead of BGR
+def queue_contour_image(writer, path, frame, contour, offset, center, rgb=False):
+    if not debug_enabled(writer):
+        return
+    if writer["level"] == "thumbnails":
+        frame, scale = make_thumbnail(frame)
+        contour = np.rint((contour + offset) * scale).astype(np.int32)
+        offset = (0, 0)
+        center = (center[0] * scale, center[1] * scale)
+    queue_debug_job(writer, (path, frame, contour, offset, center, rgb))
+
+def queue_debug_job(writer, job):
+    if writer is None or writer["thread"] is None:
+        return
+    size = job[1].nbytes
+    with writer["bytes_lock"]:
+        if writer["queued_bytes"] + size > writer["max_bytes"]:
+            writer["dropped"] += 1
+            return
+        writer["queued_bytes"] += size
+    try:
+        writer["queue"].put_nowait(job)
+    except queue.Full:
+        with writer["bytes_lock"]:
+            writer["queued_bytes"] -= size
+            writer["dropped"] += 1
+
+# Waits for the queued images to be written and stops the thread
+def stop_debug_writer(writer):
+    if writer is None or writer["thread"] is None:
+        return
+    writer["queue"].put(None)
+    writer["thread"].join()
+    writer["thread"] = None
+    if writer["dropped"]:
+        print(f"Debug writer dropped {writer['dropped']} images (disk too slow)")
+
+def run_debug_writer(writer):
+    # Folders that already exist, so makedirs is only called once per folder
+    made_folders = set()
+
+    while True:
+        job = writer["queue"].get()
+        if job is None:
+            break
+
+        path, image, contour, offset, center, rgb = job
+        try:
+            # Draw the outline and center point on a copy of the image (the thumbnail or the original frame)
+            if contour is not None:
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR) if rgb else image.copy()
+                cv2.drawContours(image, [contour], -1, (0, 0, 255), 2, offset=offset)
+                cv2.circle(image, (int(center[0]), int(center[1])), 5, (0, 0, 255), -1)
+
+            folder = os.path.dirname(path)
+            if folder not in made_folders:
+                os.makedirs(folder, exist_ok=True)
+                made_folders.add(folder)
+
+            cv2.imwrite(path, image)
+            writer["written"] += 1
+        except Exception as e:
+            print(f"Error writing debug image {path}: {e}")
+        finally:
+            with writer["bytes_lock"]:
+                writer["queued_bytes"] -= job[1].nbytes
@@ -0,0 +1,196 @@
+import numpy as np
+import cv2
+from scipy.optimize import least_squares
+from scipy.sparse import lil_matrix
+from triangulation import LED_DTYPE, undistort_pixels
+
+# Reconstruction from more than two camera positions
+# The camera positions don't have to be measured, they are found from the LEDs
+# that are seen from more than one position, and then everything is refined
+# together with bundle adjustment (see https://scipy-cookbook.readthedocs.io/items/bundle_adjustment.html)
+
+# Minimum number of already known 3D LEDs to find the position of a new camera
+min_pnp_points = 6
+
+# P = K[R|t] from a rotation vector and translation
+def projection_matrix(mtx, rvec, tvec):
+    R, _ = cv2.Rodrigues(np.asarray(rvec, dtype=np.float64))
+    return mtx @ np.hstack((R, np.asarray(tvec, dtype=np.float64).reshape(3, 1)))
+
+# Rotates points by rotation vectors (one rotation vector per point)
+# Rodrigues formula, so all points are rotated at once
+def rotate(points, rot_vecs):
+    theta = np.linalg.norm(rot_vecs, axis=1)[:, np.newaxis]
+    with np.errstate(invalid='ignore'):
+        v = rot_vecs / theta
+        v = np.nan_to_num(v)
+    dot = np.sum(points * v, axis=1)[:, np.newaxis]
+    cos_theta = np.cos(theta)
+    sin_theta = np.sin(theta)
+    return cos_theta * points + sin_theta * np.cross(v, points) + dot * (1 - cos_theta) * v
+
+# Projects 3D points with the camera (rotation vector + translation) of each point
+def project(points, camera_params, mtx):
+    points_cam = rotate(points, camera_params[:, :3]) + camera_params[:, 3:6]
+    xy = points_cam[:, :2] / points_cam[:, 2, np.newaxis]
+    return np.column_stack((mtx[0, 0] * xy[:, 0] + mtx[0, 2],
+                            mtx[1, 1] * xy[:, 1] + mtx[1, 2]))
+
+# Triangulates the LEDs in ids from the first two posed cameras that see them
+def triangulate_new(ids, observations, poses, mtx):
+    points = {}
+    for led_id in ids:
+        seen = [(cam, point) for cam, point in observations[led_id].items() if cam in poses]
+        if len(seen) < 2:
+            continue
+        (cam_a, point_a), (cam_b, point_b) = seen[:2]
+        point_4d = cv2.triangulatePoints(projection_matrix(mtx, *poses[cam_a]),
+                                         projection_matrix(mtx, *poses[cam_b]),
+                                         point_a.reshape(2, 1), point_b.reshape(2, 1))
+        points[led_id] = point_4d[:3, 0] / point_4d[3, 0]
+    return points
+
+# Jacobian sparsity for bundle adjustment
+# Each observation (2 residuals) only depends on its camera (6 values) and its LED (3 values)
+# Camera 0 is fixed at the origin, so it has no values
+def bundle_adjustment_sparsity(num_cameras, num_points, camera_indices, point_indices):
+    m = camera_indices.size * 2
+    n = (num_cameras - 1) * 6 + num_points * 3
+    A = lil_matrix((m, n), dtype=int)
+
+    rows = np.arange(camera_indices.size)
+    moving = camera_indices > 0
+    for s in range(6):
+        A[2 * rows[moving], (camera_indices[moving] - 1) * 6 + s] = 1
+        A[2 * rows[moving] + 1, (camera_indices[moving] - 1) * 6 + s] = 1
+
+    for s in range(3):
+        A[2 * rows, (num_cameras - 1) * 6 + point_indices * 3 + s] = 1
+        A[2 * rows + 1, (num_cameras - 1) * 6 + point_indices * 3 + s] = 1
+
+    return A
+
+# Refines all camera positions and LED positions together
+# so the reprojection error over every observation is as small as possible
+def bundle_adjust(cameras, points, camera_indices, point_indices, observed, mtx):
+    num_cameras = len(cameras)
+    num_points = len(points)
+
+    def unpack(params):
+        camera_params = np.vstack((np.zeros(6), params[:(num_cameras - 1) * 6].reshape(-1, 6)))
+        return camera_params, params[(num_cameras - 1) * 6:].reshape(-1, 3)
+
+    def residuals(params):
+        camera_params, points_3d = unpack(params)
+        projected = project(points_3d[point_indices], camera_params[camera_indices], mtx)
+        return (projected - observed).ravel()
+
+    x0 = np.hstack((cameras[1:].ravel(), points.ravel()))
+    A = bundle_adjustment_sparsity(num_cameras, num_points, camera_indices, point_indices)
+    # soft_l1 so a few bad detections don't pull the whole result
+    result = least_squares(residuals, x0, jac_sparsity=A, x_scale='jac', ftol=1e-6,
+                           method='trf', loss='soft_l1', f_scale=2.0)
+    return unpack(result.x)
+
+# Finds the 3D position of every LED seen from at least two camera positions
+# views is a list with one dict per camera position: {led_id: (x, y)} in pixels
+# baseline is the distance (mm) between the first two camera positions, which sets the scale
+# Returns a dict with the LEDs (LED_DTYPE array), camera poses and number of views per LED
+def reconstruct_views(views, mtx, dist, baseline=2000.0):
+    mtx = np.asarray(mtx, dtype=np.float64)
+
+    # observations[led_id][camera] = undistorted pixel position
+    observations = {}
+    for cam, view in enumerate(views):
+        if not view:
+            continue
+        ids = list(view.keys())
+        undistorted = undistort_pixels([view[led_id] for led_id in ids], mtx, dist)
+        for led_id, point in zip(ids, undistorted):
+            observations.setdefault(int(led_id), {})[cam] = point
+
+    # Start with the first two cameras, their relative pose comes from the essential matrix
+    common = [led_id for led_id, seen in observations.items() if 0 in seen and 1 in seen]
+    if len(common) < 5:
+        raise ValueError(f"Need at least 5 LEDs seen from both of the first two positions, got {len(common)}")
+
+    points_0 = np.array([observations[led_id][0] for led_id in common])
+    points_1 = np.array([observations[led_id][1] for led_id in common])
+    E, mask = cv2.findEssentialMat(points_0, points_1, mtx, method=cv2.RANSAC, prob=0.999, threshold=1.0)
+    _, R, t, _ = cv2.recoverPose(E, points_0, points_1, mtx, mask=mask)
+
+    # recoverPose gives a unit translation, scale it to the baseline
+    poses = {
+        0: (np.zeros(3), np.zeros(3)),
+        1: (cv2.Rodrigues(R)[0].ravel(), t.ravel() * baseline)
+    }
+    points_3d = triangulate_new(observations.keys(), observations, poses, mtx)
+
+    # Add the other cameras one at a time, from the LEDs that are already known
+    for cam in range(2, len(views)):
+        known = [led_id for led_id in points_3d if cam in observations[led_id]]
+        if len(known) < min_pnp_points:
+            print(f"Skipping camera position {cam}, only {len(known)} known LEDs are visible")
+            continue
+        object_points = np.array([points_3d[led_id] for led_id in known])
+        image_points = np.array([observations[led_id][cam] for led_id in known])
+        ok, rvec, tvec, _ = cv2.solvePnPRansac(object_points, image_points, mtx, None)
+        if not ok:
+            print(f"Could not find camera position {cam}")
+            continue
+        poses[cam] = (rvec.ravel(), tvec.ravel())
+
+        # LEDs that are now seen from two posed cameras
+        unknown = [led_id for led_id in observations if led_id not in points_3d]
+        points_3d.update(triangulate_new(unknown, observations, poses, mtx))
+
+    # Arrays for bundle adjustment, cameras are renumbered so camera 0 stays first
+    cams = sorted(poses)
+    cam_index = {cam: i for i, cam in enumerate(cams)}
+    led_ids = np.array(sorted(points_3d), dtype=int)
+    point_index = {led_id: i for i, led_id in enumerate(led_ids)}
+
+    camera_indices = []
+    point_indices = []
+    observed = []
+    for led_id in led_ids:
+        for cam, point in observations[led_id].items():
+            if cam in cam_index:
+                camera_indices.append(cam_index[cam])
+                point_indices.append(point_index[led_id])
+                observed.append(point)
+    camera_indices = np.array(camera_indices)
+    point_indices = np.array(point_indices)
+    observed = np.array(observed)
+
+    cameras = np.array([np.hstack(poses[cam]) for cam in cams])
+    points = np.array([points_3d[led_id] for led_id in led_ids])
+    cameras, points = bundle_adjust(cameras, points, camera_indices, point_indices, observed, mtx)
+
+    # Bundle adjustment can change the scale, so set the baseline again
+    # (camera 0 is at the origin, so the baseline is the distance to camera 1's center)
+    if 1 in cam_index:
+        R1, _ = cv2.Rodrigues(cameras[cam_index[1], :3])
+        center_1 = -R1.T @ cameras[cam_index[1], 3:]
+        scale = baseline / np.linalg.norm(center_1)
+        cameras[:, 3:] *= scale
+        points *= scale
+
+    # RMS reprojection error per LED, in pixels
+    projected = project(points[point_indices], cameras[camera_indices], mtx)
+    squared = np.sum((projected - observed) ** 2, axis=1)
+    counts = np.bincount(point_indices, minlength=len(led_ids))
+    errors = np.sqrt(np.bincount(point_indices, weights=squared, minlength=len(led_ids)) / counts)
+
+    leds = np.empty(len(led_ids), dtype=LED_DTYPE)
+    leds["id"] = led_ids
+    leds["x"] = points[:, 0]
+    leds["y"] = points[:, 1]
+    leds["z"] = points[:, 2]
+    leds["error"] = errors
+
+    return {
+        "leds": leds,
+        "cameras": {cam: cameras[cam_index[cam]] for cam in cams},
+        "views_per_led": counts
+    }
@@ -0,0 +1,117 @@
+import os
+import json
+import queue
+import threading
+import cv2
+
+# Recordings of the capture, so detection and triangulation can be run again
+# without the camera and the LEDs (e.g. on a laptop)
+# Every angle gets a folder with one PNG per frame and a frames.json that says
+# which LED (or pattern) was lit in each frame
+# The frames keep the channels the camera gives ([R, G, B, 255] from the live camera),
+# so --replay runs the detectors on the same frames as a live capture
+recordings_folder = os.path.join('data', 'recordings')
+
+# PNG is lossless, level 1 is the fastest compression
+png_params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+# The metadata from Picamera2 that is saved with each frame
+saved_metadata = ("SensorTimestamp", "ExposureTime", "FrameDuration", "AnalogueGain")
+
+# Most frames that can wait to be written (a full resolution frame is 48 MB)
+# Recorded frames are never dropped like debug images, capture waits when the queue is full
+max_queued_frames = 4
+
+def recording_folder(angle_name):
+    return os.path.join(recordings_folder, angle_name)
+
+# Starts a new recording for an angle
+# mode is "single" or "binary" and num_leds the number of LEDs on the strip
+# A background thread does the slow PNG encoding and writing, so capture doesn't wait for it
+def start_recording(angle_name, mode, num_leds):
+    folder = recording_folder(angle_name)
+    os.makedirs(folder, exist_ok=True)
+    recorder = {
+        "folder": folder,
+        "mode": mode,
+        "num_leds": num_leds,
+        "frames": [],
+        "queue": queue.Queue(maxsize=max_queued_frames),
+        "thread": None,
+        "failed": 0
+    }
+    recorder["thread"] = threading.Thread(target=run_recorder, args=(recorder,), daemon=True)
+    recorder["thread"].start()
+    return recorder
+
+# Queues one RGB (or RGBX) frame from the camera to be saved
+# led is the LED index (single mode), pattern says what was lit ("dark", "on", "bit 3", ...)
+# The frame is not copied, so it must not be changed after this
+def record_frame(recorder, frameRGB, metadata, led=None, pattern=None):
+    if recorder is None:
+        return
+    file_name = f"frame_{len(recorder['frames']):04d}.png"
+    recorder["queue"].put((os.path.join(recorder["folder"], file_name), frameRGB))
+    recorder["frames"].append({
+        "file": file_name,
+        "led": led,
+        "pattern": pattern,
+        "metadata": {key: metadata[key] for key in saved_metadata if key in metadata}
+    })
+
+# Waits for the queued frames to be written and writes the frame list, call this when the angle is done
+def finish_recording(recorder):
+    if recorder is None:
+        return
+    if recorder["thread"] is not None:
+        recorder["queue"].put(None)
+        recorder["thread"].join()
+        recorder["thread"] = None
+    if recorder["failed"]:
+        print(f"Could not write {recorder['failed']} recorded frames, replay will miss them")
+    with open(os.path.join(recorder["folder"], "frames.json"), "w") as f:
+        json.dump({
+            "mode": recorder["mode"],
+            "num_leds": recorder["num_leds"],
+            "frames": recorder["frames"]
+        }, f, indent=1)
+    print(f"Recorded {len(recorder['frames'])} frames to {recorder['folder']}")
+
+def run_recorder(recorder):
+    while True:
+        job = recorder["queue"].get()
+        if job is None:
+            break
+
+        path, frameRGB = job
+        try:
+            # cv2 saves BGR (or BGRA with a 4th channel)
+            if frameRGB.ndim == 3 and frameRGB.shape[2] == 4:
+                frameBGR = cv2.cvtColor(frameRGB, cv2.COLOR_RGBA2BGRA)
+            else:
+                frameBGR = cv2.cvtColor(frameRGB, cv2.COLOR_RGB2BGR)
+            if not cv2.imwrite(path, frameBGR, png_params):
+                raise IOError("imwrite failed")
+        except Exception as e:
+            recorder["failed"] += 1
+            print(f"Error writing recorded frame {path}: {e}")
+
+# Loads the frame list of a recorded angle
+# The file names are made into full paths
+def load_recording(angle_name):
+    folder = recording_folder(angle_name)
+    with open(os.path.join(folder, "frames.json"), "r") as f:
+        recording = json.load(f)
+    for frame in recording["frames"]:
+        frame["path"] = os.path.join(folder, frame["file"])
+    return recording
+
+# Loads a recorded frame as RGB, the same as capture_array gives
+# The 4th channel is kept if it was recorded (older recordings only have 3)
+def load_frame(path):
+    frameBGR = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if frameBGR is None:
+        raise FileNotFoundError(f"Could not read recorded frame {path}")
+    if frameBGR.ndim == 3 and frameBGR.shape[2] == 4:
+        return cv2.cvtColor(frameBGR, cv2.COLOR_BGRA2RGBA)
+    return cv2.cvtColor(frameBGR, cv2.COLOR_BGR2RGB)
@@ -0,0 +1,41 @@
+import os
+import sys
+import numpy as np
+import cv2
+
+# Runs the LED detectors on made up camera frames, no camera or LEDs needed
+# The frames have the same shape as the live camera (4608x2592, 4 channels [R, G, B, 255]),
+# and 3 channels like the older recordings
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from capture_plans import make_dark_reference, process_led_frame
+
+# A dark room with some noise, and a blue LED of size x size pixels at (x, y)
+def create_frames(x, y, size, channels=4, background=30):
+    rng = np.random.default_rng(0)
+    dark = rng.integers(background - 5, background + 5, (2592, 4608, channels), dtype=np.uint8)
+    if channels == 4:
+        dark[:, :, 3] = 255
+    lit = dark.copy()
+    lit[y:y + size, x:x + size, 2] = 255
+    return dark, lit
+
+def test_detectors():
+    for channels in (4, 3):
+        for size in (4, 20):
+            for x, y in ((100, 100), (2301, 1203), (4500, 2500)):
+                dark, lit = create_frames(x, y, size, channels)
+                center = (x + (size - 1) / 2, y + (size - 1) / 2)
+                reference = make_dark_reference(dark)
+                for name, ref in (("difference", reference), ("color", None)):
+                    position, _ = process_led_frame(lit, 0, "test", ref, None)
+                    print(f"{name} detector, {channels} channels, {size} px LED at {center}: {position}")
+                    assert position is not None, "LED not found"
+                    assert np.hypot(position[0] - center[0], position[1] - center[1]) < 1.0
+
+                    # Nothing lit, nothing found
+                    if ref is not None:
+                        position, _ = process_led_frame(dark, 0, "test", ref, None)
+                        assert position is None
+
+if __name__ == "__main__":
+    test_detectors()
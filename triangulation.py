@@ -0,0 +1,108 @@
+import numpy as np
+import cv2
+
+# Triangulation shared by capture_plans.py and view_plans.py
+# Everything works on whole arrays at once, no loops over the LEDs
+
+# A plan (the LEDs found from one camera angle), sorted by LED ID
+PLAN_DTYPE = np.dtype([("id", "<i4"), ("x", "<f8"), ("y", "<f8")])
+
+# The 3D result for each LED, error is the reprojection error in pixels
+LED_DTYPE = np.dtype([("id", "<i4"), ("x", "<f8"), ("y", "<f8"), ("z", "<f8"), ("error", "<f8")])
+
+# Default reprojection error (pixels) above which a LED should be captured again
+max_reprojection_error = 5.0
+
+# Makes a plan array from the list of (id, x, y) from capture_plan,
+# or from the Nx3 array in data/plan_{angle}.npy
+def plan_to_records(positions):
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    plan = np.empty(len(positions), dtype=PLAN_DTYPE)
+    plan["id"] = positions[:, 0]
+    plan["x"] = positions[:, 1]
+    plan["y"] = positions[:, 2]
+    return np.sort(plan, order="id")
+
+# Makes the Nx3 (id, x, y) array that is saved in data/plan_{angle}.npy
+def plan_to_array(plan):
+    return np.column_stack((plan["id"], plan["x"], plan["y"]))
+
+# Loads data/plan_{angle}.npy as a plan array
+def load_plan(angle_name):
+    return plan_to_records(np.load(f"data/plan_{angle_name}.npy"))
+
+# Replaces the rows of old that have the same LED ID as a row in new,
+# and adds the new LEDs (works for plans and LED arrays)
+def merge_by_id(old, new):
+    kept = old[~np.isin(old["id"], new["id"])]
+    return np.sort(np.concatenate((kept, new.astype(old.dtype))), order="id")
+
+# The x, y columns of a plan as a Nx2 array
+def plan_points(plan):
+    return np.column_stack((plan["x"], plan["y"]))
+
+# Finds the LEDs that are in both plans
+# Returns the LED IDs and the Nx2 positions from each plan, in the same order
+def join_views(plan_a, plan_b):
+    ids, index_a, index_b = np.intersect1d(plan_a["id"], plan_b["id"], assume_unique=True, return_indices=True)
+    return ids, plan_points(plan_a[index_a]), plan_points(plan_b[index_b])
+
+# Removes lens distortion, the result is still in pixels for the camera matrix
+# so it can be used with P = K[R|t]
+def undistort_pixels(points, mtx, dist):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+    if len(points) == 0:
+        return points.reshape(0, 2)
+    return cv2.undistortPoints(points, mtx, dist, P=mtx).reshape(-1, 2)
+
+# P = K[R|t] where K is the camera matrix
+def create_projection_matrices(mtx, R1, t1, R2, t2):
+    P1 = np.dot(mtx, np.hstack((R1, t1)))
+    P2 = np.dot(mtx, np.hstack((R2, t2)))
+    return P1, P2
+
+# Triangulates undistorted Nx2 points from two cameras, returns Nx3 points
+# See https://stackoverflow.com/questions/55740284/how-to-triangulate-a-point-in-3d-space-given-coordinate-points-in-2-image-and-e
+def triangulate(points_a, points_b, P1, P2):
+    # triangulatePoints wants 2xN arrays and returns 4xN homogeneous coordinates (X,Y,Z,W)
+    points_4d = cv2.triangulatePoints(P1, P2, points_a.T, points_b.T)
+    return (points_4d[:3] / points_4d[3]).T
+
+# Projects Nx3 points with a projection matrix, returns Nx2 pixel positions
+def project_points(points_3d, P):
+    projected = np.hstack((points_3d, np.ones((len(points_3d), 1)))) @ P.T
+    return projected[:, :2] / projected[:, 2:3]
+
+# Reprojection error of each LED, the largest of the two views (pixels)
+def reprojection_errors(points_3d, points_a, points_b, P1, P2):
+    error_a = np.linalg.norm(project_points(points_3d, P1) - points_a, axis=1)
+    error_b = np.linalg.norm(project_points(points_3d, P2) - points_b, axis=1)
+    return np.maximum(error_a, error_b)
+
+# Joins, undistorts and triangulates two plans
+# Returns a LED_DTYPE array with one row per LED seen in both plans
+def triangulate_plans(plan_a, plan_b, P1, P2, mtx, dist):
+    ids, points_a, points_b = join_views(plan_a, plan_b)
+    points_a = undistort_pixels(points_a, mtx, dist)
+    points_b = undistort_pixels(points_b, mtx, dist)
+
+    leds = np.empty(len(ids), dtype=LED_DTYPE)
+    leds["id"] = ids
+    if len(ids) == 0:
+        return leds
+
+    points_3d = triangulate(points_a, points_b, P1, P2)
+    leds["x"] = points_3d[:, 0]
+    leds["y"] = points_3d[:, 1]
+    leds["z"] = points_3d[:, 2]
+    leds["error"] = reprojection_errors(points_3d, points_a, points_b, P1, P2)
+    return leds
+
+# The x, y, z columns of a LED array as a Nx3 array
+def led_points(leds):
+    return np.column_stack((leds["x"], leds["y"], leds["z"]))
+
+# Splits the LEDs into good ones and ones with a too high reprojection error
+def split_outliers(leds, max_error=max_reprojection_error):
+    bad = leds["error"] > max_error
+    return leds[~bad], leds[bad]
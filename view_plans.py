@@ -3,6 +3,13 @@ import matplotlib.pyplot as plt
 from scipy.spatial.transform import Rotation
 import cv2
 import yaml
+from triangulation import (
+    max_reprojection_error,
+    create_projection_matrices,
+    load_plan,
+    triangulate_plans,
+    led_points
+)
 
 def load_calibration():
     with open("calibration_matrix.yaml", 'r') as f:
@@ -11,29 +18,6 @@ def load_calibration():
     dist = np.array(calibration_data['dist_coeff'])
     return mtx, dist
 
-def create_projection_matrices(mtx, R1, t1, R2, t2):
-    # First camera projection matrix
-    P1 = np.dot(mtx, np.hstack((R1, t1)))
-
-    # Second camera projection matrix
-    P2 = np.dot(mtx, np.hstack((R2, t2)))
-
-    return P1, P2
-
-def triangulate_points(points1, points2, P1, P2, mtx, dist):
-    # Undistort points using camera calibration
-    points1_undist = cv2.undistortPoints(points1.reshape(-1, 1, 2), mtx, dist)
-    points2_undist = cv2.undistortPoints(points2.reshape(-1, 1, 2), mtx, dist)
-
-    # Triangulate
-    points_4d = cv2.triangulatePoints(P1, P2, 
-                                    points1_undist.reshape(2, -1),
-                                    points2_undist.reshape(2, -1))
-
-    # Convert from homogeneous coordinates to 3D
-    points_3d = points_4d[:3] / points_4d[3]
-    return points_3d.T
-
 def setup_2d_views(ax1, ax2, alpha_dict, beta_dict, common_leds):
     views = [
         ('alpha', ax1, alpha_dict, 'Front (Alpha)'),
@@ -80,18 +64,19 @@ def main():
     P1, P2 = create_projection_matrices(mtx, R1, t1, R2, t2)
 
     try:
-        alpha_positions = np.load('data/plan_alpha.npy')
-        beta_positions = np.load('data/plan_beta.npy')
+        alpha_plan = load_plan('alpha')
+        beta_plan = load_plan('beta')
     except FileNotFoundError:
         print("Error: Could not find plan data files. Run capture_plans.py first (or set_up_lights.py).")
         return
 
-    # Create dictionaries to store positions by LED ID
-    alpha_dict = {int(p[0]): (p[1], p[2]) for p in alpha_positions}
-    beta_dict = {int(p[0]): (p[1], p[2]) for p in beta_positions}
+    # Create dictionaries to store positions by LED ID (for the 2D views)
+    alpha_dict = {int(p['id']): (p['x'], p['y']) for p in alpha_plan}
+    beta_dict = {int(p['id']): (p['x'], p['y']) for p in beta_plan}
 
-    # Find common LED IDs
-    common_leds = set(alpha_dict.keys()) & set(beta_dict.keys())
+    # Triangulate the LEDs seen in both views
+    leds = triangulate_plans(alpha_plan, beta_plan, P1, P2, mtx, dist)
+    common_leds = set(leds['id'].tolist())
 
     if not common_leds:
         print("No LEDs were detected in both views!")
@@ -109,51 +94,18 @@ def main():
     # Set up the 2D views
     setup_2d_views(ax1, ax2, alpha_dict, beta_dict, common_leds)
 
-    # Prepare points for triangulation
-    points1 = []
-    points2 = []
-    led_ids = []
-
-    for led_id in sorted(common_leds):
-        points1.append(alpha_dict[led_id])
-        points2.append(beta_dict[led_id])
-        led_ids.append(led_id)
-
-    points1 = np.array(points1, dtype=np.float32)
-    points2 = np.array(points2, dtype=np.float32)
-
-    # Triangulate 3D points
-    points_3d = triangulate_points(points1, points2, P1, P2, mtx, dist)
-
-    # Store and visualize 3D positions
-    led_positions_3d = {}
-    x_coords = []
-    y_coords = []
-    z_coords = []
-
-    for i, point3d in enumerate(points_3d):
-        led_id = led_ids[i]
-        led_positions_3d[led_id] = {
-            "id": led_id,
-            "x": point3d[0],
-            "y": point3d[1],
-            "z": point3d[2]
-        }
-
-        # Coordinates for scaling
-        x_coords.append(point3d[0])
-        y_coords.append(point3d[1])
-        z_coords.append(point3d[2])
-
-        # Plot point in 3D
-        ax3.scatter(point3d[0], point3d[1], point3d[2], color='blue', s=100)
+    # Plot the 3D points, LEDs with a high reprojection error are red
+    points_3d = led_points(leds)
+    outliers = leds['error'] > max_reprojection_error
+    colors = np.where(outliers, 'red', 'blue')
+    ax3.scatter(points_3d[:, 0], points_3d[:, 1], points_3d[:, 2], c=colors, s=100)
+    for led_id, point3d in zip(leds['id'], points_3d):
         ax3.text(point3d[0], point3d[1], point3d[2], f'{led_id}')
 
     # Calculate bounds for scaling
     padding = 0.1
-    x_min, x_max = min(x_coords), max(x_coords)
-    y_min, y_max = min(y_coords), max(y_coords)
-    z_min, z_max = min(z_coords), max(z_coords)
+    x_min, y_min, z_min = points_3d.min(axis=0)
+    x_max, y_max, z_max = points_3d.max(axis=0)
     x_range = (x_max - x_min) * (1 + padding)
     y_range = (y_max - y_min) * (1 + padding)
     z_range = (z_max - z_min) * (1 + padding)
@@ -190,6 +142,8 @@ def main():
     print(f"\nTotal LEDs detected in alpha view: {len(alpha_dict)}")
     print(f"Total LEDs detected in beta view: {len(beta_dict)}")
     print(f"LEDs detected in both views: {len(common_leds)}")
+    if np.any(outliers):
+        print(f"LEDs with reprojection error over {max_reprojection_error} px: {leds['id'][outliers].tolist()}")
 
     plt.tight_layout()
     plt.show()
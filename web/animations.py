@@ -1,248 +1,321 @@
-import time
-import random
-import threading
+import numpy as np
+from layout import nearest_neighbours
+from compositor import (
+    target_fps,
+    make_compositor,
+    start_compositor,
+    add_layer,
+    switch_layer,
+    remove_layers,
+    layer_names,
+    blend_modes,
+    transitions
+)
 
 # State machine
+# The compositor is made the first time an effect is started (or by client.py),
+# every running effect is a layer in it
 animation_state = {
-    "is_running": False,
+    "compositor": None,
     "current_name": None,
-    "thread": None
+    # Clips that are still baking, name: token (see clips.py)
+    "pending_clips": {}
 }
 
-# Turns off all the LEDs and stops any running animation
+# The compositor of the state, made for the layout if there is none yet
+def get_compositor(pixels, layout, state):
+    if state["compositor"] is None:
+        state["compositor"] = make_compositor(layout, len(pixels))
+    start_compositor(pixels, state["compositor"])
+    return state["compositor"]
+
+# Stops all running animations, the LEDs go back to their base colors
+# Clips that are still baking won't start either
 def stop_all_animations(pixels, state):
-    state["is_running"] = False
+    state["pending_clips"].clear()
+    if state["compositor"] is not None:
+        remove_layers(state["compositor"])
+    state["current_name"] = None
+
+# Stops one animation, returns False if it was not running (or baking)
+def stop_animation(pixels, state, name):
+    baking = state["pending_clips"].pop(name, None) is not None
+    if state["compositor"] is None or not remove_layers(state["compositor"], name):
+        return baking
+    names = layer_names(state["compositor"])
+    state["current_name"] = names[-1] if names else None
+    return True
 
-    # Wait for animation to finish
-    if state["thread"]:
-        state["thread"].join()
-        state["thread"] = None
+# Colors in GBR format (like the strip wants)
+BLUE = np.array([0, 255, 0], dtype=np.float32)
+WHITE = np.array([255, 255, 255], dtype=np.float32)
+SOFT_WHITE = np.array([200, 200, 200], dtype=np.float32)
+SUN = np.array([200, 100, 0], dtype=np.float32) # Orange/yellow
 
-    # Turn off all LEDs
-    pixels.fill((0, 0, 0))
-    pixels.show()
+# The rainbow colors from make_rainbow_color, red at the top and blue at the bottom
+RAINBOW = np.array([(0, 0, 255), (127, 0, 255), (255, 0, 255), (255, 0, 0), (0, 255, 0)], dtype=np.uint8)
 
 # Creates a rainbow color (returns color in GBR....)
 # position should olny be between 0 and 1
 # where red is at the top and blue is at the bottom
 def make_rainbow_color(position):
-    if position < 0.2:
-        return (0, 0, 255) # Red
-    elif position < 0.4:
-        return (127, 0, 255) # Orange
-    elif position < 0.6:
-        return (255, 0, 255) # Yellow
-    elif position < 0.8:
-        return (255, 0, 0) # Green
-    else:
-        return (0, 255, 0) # Blue
+    return tuple(int(c) for c in rainbow_colors(np.array([position]))[0])
+
+# Same as make_rainbow_color, for a whole array of positions at once
+def rainbow_colors(positions):
+    return RAINBOW[np.clip((positions * len(RAINBOW)).astype(np.intp), 0, len(RAINBOW) - 1)]
+
+# Arrays the effects use, from the layout (worked out once in layout.prepare_layout)
+# height: 0 to 1, 1 is the top (the LED with the highest y, same as the old sorting)
+# angle: 0 to 1 around the middle of the tree
+def effect_arrays(layout):
+    positions = np.asarray(layout["xyz"], dtype=np.float32)
+    cylindrical = layout["cylindrical"]
+    return positions, cylindrical[:, 1], cylindrical[:, 0]
+
+# Writes a (N,) brightness (0 to 1) times a color into the frame
+def fill_brightness(frame, brightness, color):
+    np.multiply(brightness[:, np.newaxis], color, out=frame, casting="unsafe")
 
 # Makes LEDs light up in blue, in a pattern so it looks
 # like rain falling
-def run_rain_effect(pixels, led_positions, state):
-    # Sort LEDs by height
-    for i in range(len(led_positions)):
-        print(led_positions[i]['y'])
-
-    sorted_leds = sorted(led_positions, key=lambda x: x['y'], reverse=True)
-    for j in range(len(sorted_leds)):
-        print(sorted_leds[j]['y'])
-
-    while state["is_running"]:
-        lit_leds = []
-
-        # Light up LEDs from top to bottom
-        for led in sorted_leds:
-            if not state["is_running"]:
-                break
-
-            # Turn on one LED in blue
-            led_id = led['id']
-            pixels[led_id] = (0, 255, 0)  # Blue in GBR format
-            lit_leds.append(led_id)
-            pixels.show()
-            time.sleep(0.05)
-
-            # Keep last 3 LEDs lit
-            # at the same time
-            if len(lit_leds) > 3:
-                old_led = lit_leds.pop(0)
-                pixels[old_led] = (0, 0, 0)
-                pixels.show()
-
-        # Turn off remaining lit LEDs
-        for led_id in lit_leds:
-            if not state["is_running"]:
-                break
-            pixels[led_id] = (0, 0, 0)
-            pixels.show()
-            time.sleep(0.05)
-
-        time.sleep(random.uniform(0.1, 0.5))
+# Every LED belongs to one of a few lanes around the tree, and each lane has a drop
+# falling at its own speed with a fading tail
+def make_rain_effect(layout, lanes=8, tail=0.25, seed=None):
+    rng = np.random.default_rng(seed)
+    positions, height, angle = effect_arrays(layout)
+    lane = (angle * lanes).astype(np.intp) % lanes
+    speed = rng.uniform(0.5, 1.0, lanes).astype(np.float32) # Tree heights per second
+    offset = rng.uniform(0, 1, lanes).astype(np.float32)
+
+    def render(t, dt, frame):
+        # Height of the drop in each lane, it falls from above the top to below the bottom
+        head = 1.0 + tail - ((t * speed + offset) % (1.0 + 2 * tail))
+        # How far above the drop each LED is, only the tail just above the drop is lit
+        behind = height - head[lane]
+        brightness = np.where((behind >= 0) & (behind < tail), 1.0 - behind / tail, 0.0)
+        fill_brightness(frame, brightness, BLUE)
+
+    return render
 
 # Makes LEDs light up in a spiral pattern
 # where the color of the LED depends on its height
-def run_spiral_effect(pixels, led_positions, state):
-    # Sort LEDs by height
-    sorted_leds = sorted(led_positions, key=lambda x: x['y'], reverse=True)
-    speed = 0.15 # Lower is faster
+def make_spiral_effect(layout, turns=3.0, speed=0.5, width=0.35, seed=None):
+    positions, height, angle = effect_arrays(layout)
+    colors = rainbow_colors(1.0 - height).astype(np.float32)
 
-    while state["is_running"]:
-        pixels.fill((0, 0, 0))
-        pixels.show()
+    def render(t, dt, frame):
+        # A band that winds around the tree and moves down over time
+        phase = (angle + height * turns + t * speed) % 1.0
+        brightness = np.clip(1.0 - phase / width, 0.0, 1.0)
+        np.multiply(colors, brightness[:, np.newaxis], out=frame, casting="unsafe")
 
-        for i, led in enumerate(sorted_leds):
-            if not state["is_running"]:
-                break
+    return render
 
-            height_percent = i / len(sorted_leds)
-            color = make_rainbow_color(height_percent)
+# A flat plane of light that moves through the tree
+# direction is the normal of the plane (in the normalized layout space)
+def make_sweep_effect(layout, direction=(0.0, -1.0, 0.0), period=2.0, width=0.15, color=(255, 255, 255),
+                      seed=None):
+    normalized = np.asarray(layout["normalized"], dtype=np.float32)
+    direction = np.asarray(direction, dtype=np.float32)
+    direction /= np.linalg.norm(direction)
+    # Distance of every LED along the direction, from 0 to 1
+    distance = normalized @ direction
+    if len(distance):
+        distance = (distance - distance.min()) / max(float(np.ptp(distance)), 1e-6)
+    color = np.asarray(color, dtype=np.float32)
 
-            pixels[led['id']] = color
-            pixels.show()
-            time.sleep(speed)
+    def render(t, dt, frame):
+        plane = (t / period) % 1.0 * (1 + 2 * width) - width
+        brightness = np.clip(1.0 - np.abs(distance - plane) / width, 0.0, 1.0)
+        fill_brightness(frame, brightness, color)
 
-        if state["is_running"]:
-            time.sleep(1.0)
+    return render
 
 # Lightning effect
 # White flashing
-def run_lightning_effect(pixels, led_positions, state):
-    sorted_leds = sorted(led_positions, key=lambda x: x['y'], reverse=True)
-    
-    while state["is_running"]:
-        flashes = random.randint(1, 3)
-        for _ in range(flashes):
-            for led in sorted_leds:
-                pixels[led['id']] = (255, 255, 255) # White
-            pixels.show()
-            
-            time.sleep(0.1)
-            
-            # Turn all LEDs off
-            for led in sorted_leds:
-                pixels[led['id']] = (0, 0, 0)
-            pixels.show()
-            
-            time.sleep(0.1)
-        
-        time.sleep(random.uniform(2.0, 5.0))
+def make_lightning_effect(layout, seed=None):
+    rng = np.random.default_rng(seed)
+    # Times (from, to) where the LEDs are white, and when the next storm starts
+    storm = {"flashes": [], "end": 0.0}
+
+    def render(t, dt, frame):
+        if t >= storm["end"]:
+            flashes = int(rng.integers(1, 4))
+            storm["flashes"] = [(t + i * 0.2, t + i * 0.2 + 0.1) for i in range(flashes)]
+            storm["end"] = t + flashes * 0.2 + rng.uniform(2.0, 5.0)
+
+        if any(start <= t < end for start, end in storm["flashes"]):
+            frame[:] = WHITE
+        else:
+            frame[:] = 0
+
+    return render
 
 # Gentle snow effect
-# White falling
-def run_snow_effect(pixels, led_positions, state):
-    sorted_leds = sorted(led_positions, key=lambda x: x['y'], reverse=True)
-    
-    while state["is_running"]:
-        num_snowflakes = random.randint(1, 5)
-        lit_leds = []
-        
-        for _ in range(num_snowflakes):
-            if len(sorted_leds) > 0:
-                led = random.choice(sorted_leds)
-                pixels[led['id']] = (200, 200, 200) # Soft white
-                lit_leds.append(led['id'])
-                pixels.show()
-                
-        time.sleep(0.3)
-        
-        # Turn off snowflakes
-        for led_id in lit_leds:
-            pixels[led_id] = (0, 0, 0)
-        pixels.show()
-        
-        time.sleep(0.2)
+# White flakes that drift down to a nearby lower LED every step
+def make_snow_effect(layout, flakes=3.0, step_time=0.3, seed=None):
+    rng = np.random.default_rng(seed)
+    positions, height, angle = effect_arrays(layout)
+    count = len(height)
+    # The nearby LEDs that are lower, a flake can drift to one of them
+    nearest = nearest_neighbours(layout, 6)
+    lower = height[nearest] < height[:, np.newaxis] if count else np.zeros((0, 0), dtype=bool)
+    # About the same number of flakes as before, no matter how many LEDs
+    snow = {"step": -1, "flakes": np.zeros(0, dtype=np.intp)}
+
+    def render(t, dt, frame):
+        step = int(t / step_time)
+        if step != snow["step"] and count:
+            snow["step"] = step
+            current = snow["flakes"]
+            # Pick a random lower neighbour for every flake, flakes with none melt
+            choice = np.where(lower[current], rng.random(lower[current].shape), -1.0)
+            best = choice.argmax(axis=1) if len(current) else np.zeros(0, dtype=np.intp)
+            keep = choice[np.arange(len(current)), best] >= 0 if len(current) else np.zeros(0, dtype=bool)
+            moved = nearest[current[keep], best[keep]]
+            # New flakes start near the top
+            new = rng.choice(layout["order"][1][-max(count // 4, 1):], rng.poisson(flakes / 2))
+            snow["flakes"] = np.concatenate((moved, new)).astype(np.intp)
+
+        frame[:] = 0
+        frame[snow["flakes"]] = SOFT_WHITE
+
+    return render
+
+# Rings of light that spread out from a random LED
+def make_ripple_effect(layout, speed=600.0, width=80.0, period=3.0, color=(255, 0, 255), seed=None):
+    rng = np.random.default_rng(seed)
+    positions, height, angle = effect_arrays(layout)
+    color = np.asarray(color, dtype=np.float32)
+    ripple = {"number": -1, "distance": np.zeros(len(positions), dtype=np.float32)}
+
+    def render(t, dt, frame):
+        number = int(t / period)
+        if number != ripple["number"] and len(positions):
+            ripple["number"] = number
+            origin = positions[rng.integers(len(positions))]
+            ripple["distance"] = np.linalg.norm(positions - origin, axis=1)
+
+        radius = (t % period) * speed
+        brightness = np.clip(1.0 - np.abs(ripple["distance"] - radius) / width, 0.0, 1.0)
+        fill_brightness(frame, brightness, color)
+
+    return render
+
+# Sparkles that light up and spread to the nearest LEDs while they fade
+def make_sparkle_effect(layout, rate=4.0, spread=0.6, fade=0.85, color=(255, 255, 255), seed=None):
+    rng = np.random.default_rng(seed)
+    count = len(layout["ids"])
+    nearest = nearest_neighbours(layout, 4)
+    color = np.asarray(color, dtype=np.float32)
+    sparkle = {"brightness": np.zeros(count, dtype=np.float32)}
+
+    def render(t, dt, frame):
+        brightness = sparkle["brightness"]
+        # Each LED gets the faded brightness of its brightest neighbour
+        if nearest.shape[1]:
+            brightness = np.maximum(brightness * fade, brightness[nearest].max(axis=1) * spread)
+        else:
+            brightness = brightness * fade
+        if count:
+            brightness[rng.integers(count, size=rng.poisson(rate * dt))] = 1.0
+        sparkle["brightness"] = brightness
+        fill_brightness(frame, brightness, color)
+
+    return render
 
 # Gentle sun effect
 # Yellow and orange
-def run_sun_effect(pixels, led_positions, state):
-    sorted_leds = sorted(led_positions, key=lambda x: -x['y'])
-    base_color = (200, 100, 0) # Orange/yellow in GBR format
-    
-    while state["is_running"]:
-        for brightness in range(0, 100, 2):
-            if not state["is_running"]:
-                break
-                
-            factor = brightness / 100.0
-            color = tuple(int(c * factor) for c in base_color)
-            
-            for led in sorted_leds:
-                pixels[led['id']] = color
-            pixels.show()
-            time.sleep(0.02)
-            
-        for brightness in range(100, 0, -2):
-            if not state["is_running"]:
-                break
-                
-            factor = brightness / 100.0
-            color = tuple(int(c * factor) for c in base_color)
-            
-            for led in sorted_leds:
-                pixels[led['id']] = color
-            pixels.show()
+def make_sun_effect(layout, seed=None):
+    fade_time = 1.0 # Time to fade in (and out)
 
-# Starts the weather animation based on weather type
-def start_weather_animation(pixels, led_positions, state, weather_type):
-    if state["is_running"]:
-        return False
-        
-    state["is_running"] = True
-    state["current_name"] = weather_type
-    
-    if weather_type == "Rain":
-        target = run_rain_effect
-    elif weather_type == "Thunderstorm":
-        target = run_lightning_effect
-    elif weather_type == "Snow":
-        target = run_snow_effect
-    elif weather_type == "Clear":
-        target = run_sun_effect
-    else:
+    def render(t, dt, frame):
+        phase = (t % (2 * fade_time)) / fade_time
+        factor = phase if phase < 1 else 2 - phase
+        frame[:] = SUN * factor
+
+    return render
+
+# The effects that can be started, by name
+# (the weather names from the server and the names from the website)
+# Every effect is made with effect(layout, ..., seed=None) and only uses its own random generator,
+# so the same seed and the same t values always give the same frames
+effects = {
+    "Rain": make_rain_effect,
+    "rain": make_rain_effect,
+    "Thunderstorm": make_lightning_effect,
+    "lightning": make_lightning_effect,
+    "Snow": make_snow_effect,
+    "snow": make_snow_effect,
+    "Clear": make_sun_effect,
+    "clear": make_sun_effect,
+    "spiral": make_spiral_effect,
+    "sweep": make_sweep_effect,
+    "ripple": make_ripple_effect,
+    "sparkle": make_sparkle_effect
+}
+
+# Starts an effect as a layer in the compositor
+# layout is the LED layout from layout.py, the effects use its position arrays
+# More effects can run at the same time, but the same effect only once
+# With a transition ("fade", "wipe" or "cut") the effect replaces the running effects instead
+# The effect is made by the writer thread, so this returns straight away
+def start_effect(pixels, layout, state, name, blend="over", opacity=1.0, transition=None, duration=1.0):
+    if name not in effects:
         return False
+    return start_render(pixels, layout, state, name, lambda: effects[name](layout),
+                        blend, opacity, transition, duration)
 
-    state["thread"] = threading.Thread(
-        target=target,
-        args=(pixels, led_positions, state)
-    )
-    state["thread"].start()
-    return True
+# Replaces the running effects with a new one, with a transition between them
+def switch_effect(pixels, layout, state, name, transition="fade", duration=1.0):
+    return start_effect(pixels, layout, state, name, transition=transition, duration=duration)
 
-# Starts the rain animation
-def start_snow(pixels, led_positions, state):
-    if state["is_running"]:
+# Starts a layer from a function that makes its render function (e.g. a clip from clips.py)
+def start_render(pixels, layout, state, name, make_render, blend="over", opacity=1.0,
+                 transition=None, duration=1.0):
+    if blend not in blend_modes or (transition is not None and transition not in transitions):
         return False
-        
-    state["is_running"] = True
-    state["current_name"] = "rain"
-    state["thread"] = threading.Thread(
-        target=run_snow_effect, 
-        args=(pixels, led_positions, state)
-    )
-    state["thread"].start()
+    # A switch replaces everything, also clips that are still baking
+    if transition is not None:
+        state["pending_clips"].clear()
+    compositor = get_compositor(pixels, layout, state)
+    names = layer_names(compositor)
+    if transition is None:
+        if name in names:
+            return False
+        add_layer(compositor, name, make_render, blend, opacity)
+    else:
+        if names == [name]:
+            return False
+        switch_layer(compositor, name, make_render, blend, opacity, transition, duration)
+    state["current_name"] = name
     return True
 
+# Starts the weather animation based on weather type
+# It cross-fades from the animation that was running, so there is no black flash when the weather changes
+def start_weather_animation(pixels, layout, state, weather_type, transition="fade", duration=1.0):
+    return switch_effect(pixels, layout, state, weather_type, transition, duration)
+
+# Starts the snow animation
+def start_snow(pixels, layout, state):
+    return start_effect(pixels, layout, state, "snow")
+
 # Starts the spiral animation
-def start_spiral(pixels, led_positions, state):
-    if state["is_running"]:
-        return False
-        
-    state["is_running"] = True
-    state["current_name"] = "spiral"
-    state["thread"] = threading.Thread(
-        target=run_spiral_effect, 
-        args=(pixels, led_positions, state)
-    )
-    state["thread"].start()
-    return True
+def start_spiral(pixels, layout, state):
+    return start_effect(pixels, layout, state, "spiral")
 
 # Gets the current color of each LED as hex colors
-def get_current_colors(pixels, num_pixels):
+# Uses the last whole frame from the compositor if there is one (instead of the strip),
+# it is 0 to 1 so it is made 8-bit here, only when the colors are asked for
+def get_current_colors(pixels, num_pixels, state=animation_state):
+    frame = pixels
+    if state["compositor"] is not None:
+        frame = np.rint(state["compositor"]["front"] * 255.0).astype(np.uint8)
     colors = {}
     for i in range(num_pixels):
-        color = pixels[i]
+        color = frame[i]
         # Convert from GBR to hex RGB color
         hex_color = f'#{color[2]:02x}{color[0]:02x}{color[1]:02x}'
         colors[i] = hex_color
-    return colors
\ No newline at end of file
+    return colors
@@ -0,0 +1,90 @@
+import time
+import hashlib
+import argparse
+import numpy as np
+from animations import effects, target_fps
+from layout import make_layout
+from compositor import make_compositor, add_layer, compose
+from output import apply_output
+
+# Headless benchmark of the effects, no strip or Pi needed
+# Every effect is rendered with a seed and a virtual clock (t = frame / fps, no sleeping),
+# as fast as possible, so two runs render exactly the same frames and can be compared
+#
+# python bench_effects.py --leds 40 500 2000 --seconds 10
+# python bench_effects.py --effects rain snow --pipeline
+
+# One name for each effect (the website names)
+bench_names = [name for name in effects if name.islower()]
+
+# A made up tree for the benchmark: LEDs wound around a cone, 1.5 m high
+def tree_layout(count, seed=0):
+    rng = np.random.default_rng(seed)
+    height = np.linspace(0, 1, count)
+    angle = height * 40 * np.pi
+    radius = (1 - height) * 500 + 50
+    xyz = np.column_stack((radius * np.cos(angle), height * 1500, radius * np.sin(angle)))
+    return make_layout(np.arange(count), xyz + rng.normal(0, 10, xyz.shape))
+
+# Renders seconds of one effect and times every frame
+# With pipeline the frames also go through the compositor and the output stage, like on the Pi
+# Returns a dict with the results, checksum is a hash of all the frames
+def bench_effect(name, layout, seconds, fps=target_fps, seed=0, pipeline=False):
+    count = len(layout["ids"])
+    render = effects[name](layout, seed=seed)
+    frame = np.zeros((count, 3), dtype=np.uint8)
+    if pipeline:
+        compositor = make_compositor(layout, count)
+        add_layer(compositor, name, lambda: render)
+
+    frames = max(int(seconds * fps), 1)
+    times = np.empty(frames)
+    checksum = hashlib.sha1()
+    for i in range(frames):
+        t = i / fps
+        start = time.perf_counter()
+        if pipeline:
+            front = compose(compositor, t, 1.0 / fps)
+            frame = apply_output(compositor["output"], front)
+        else:
+            render(t, 1.0 / fps, frame)
+        times[i] = time.perf_counter() - start
+        checksum.update(frame.tobytes())
+
+    p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1e6
+    return {
+        "name": name,
+        "leds": count,
+        "frames": frames,
+        "fps": frames / times.sum(),
+        "p50": p50,
+        "p95": p95,
+        "p99": p99,
+        "checksum": checksum.hexdigest()[:12]
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the LED effects without a strip")
+    parser.add_argument("--effects", nargs="+", default=bench_names, choices=sorted(effects),
+                        help="Effects to benchmark (default: all)")
+    parser.add_argument("--leds", nargs="+", type=int, default=[40, 500, 2000],
+                        help="LED counts to benchmark")
+    parser.add_argument("--seconds", type=float, default=10.0, help="Seconds of animation to render")
+    parser.add_argument("--fps", type=float, default=target_fps, help="Frames per second of the virtual clock")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the effects and the made up tree")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Also time the compositor and the output stage")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    print(f"{'effect':<12}{'LEDs':>7}{'frames':>8}{'fps':>11}{'p50 us':>10}{'p95 us':>10}{'p99 us':>10}  checksum")
+    for count in args.leds:
+        layout = tree_layout(count, args.seed)
+        for name in args.effects:
+            result = bench_effect(name, layout, args.seconds, args.fps, args.seed, args.pipeline)
+            print(f"{result['name']:<12}{result['leds']:>7}{result['frames']:>8}{result['fps']:>11.0f}"
+                  f"{result['p50']:>10.1f}{result['p95']:>10.1f}{result['p99']:>10.1f}  {result['checksum']}")
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,35 @@
+import time
+import random
+import string
 import asyncio
+import threading
 import websockets
 import json
 import board
 import neopixel
 import requests
 import json
+import numpy as np
 from collections import defaultdict
 from animations import (
-    start_snow, 
-    start_spiral, 
+    effects,
+    switch_effect,
     stop_all_animations,
-    start_weather_animation
+    stop_animation
 )
+from compositor import (
+    make_compositor,
+    start_compositor,
+    stop_compositor,
+    set_base_colors,
+    flash,
+    command_metrics,
+    frame_metrics
+)
+from output import make_output
+from frames import make_frame_stream, receive_frame
+from layout import load_or_convert_layout, empty_layout
+from clips import start_clip
 
 # LED strip configuration
 pixel_pin = board.D18
@@ -21,39 +39,152 @@ num_pixels = 40 # We have 40 LEDs
 pixels = neopixel.NeoPixel(
     pixel_pin, num_pixels, brightness=1, auto_write=False
 )
+# How much current (mA) the power supply can give the LEDs, frames that would use more are dimmed
+# Full white is about 60 mA per LED
+psu_budget_ma = 2000
+# Longest flash and animation transition a command can ask for (seconds)
+max_flash_duration = 5.0
+max_transition_duration = 10.0
 led_states = defaultdict(lambda: '#000000')  # Default color is black (aka turned off)
 
 # Animation state machine like in animations.py
 animation_state = {
-    "is_running": False,
+    "compositor": None,
     "current_name": None,
-    "thread": None
+    # Clips that are still baking, name: token (see clips.py)
+    "pending_clips": {}
 }
 
-# Try to load LED positions from file
+# Try to load LED positions from the binary layout file
+# It is made from led_3d_coordinates.txt the first time (or when the text file is newer)
 try:
-    led_positions = []
-    with open('../data/led_3d_coordinates.txt', 'r') as f:
-        next(f) # Skip header line which is just "LED ID, X, Y, Z"
-        for line in f:
-            parts = line.strip().split(',')
-            led_positions.append({
-                "id": int(parts[0]),
-                "x": float(parts[1]),
-                "y": float(parts[2]),
-                "z": float(parts[3])
-            })
+    layout = load_or_convert_layout('../data/led_layout.bin', '../data/led_3d_coordinates.txt')
+    led_positions = [
+        {"id": int(led_id), "x": float(x), "y": float(y), "z": float(z)}
+        for led_id, (x, y, z) in zip(layout["ids"], layout["xyz"])
+    ]
 except Exception as e:
     print(f"Error loading LED positions: {e}")
+    layout = empty_layout()
     led_positions = []
 
+# The positions never change, so the message for the server is only made once
+positions_json = json.dumps(led_positions)
+
+# Only the compositor writes to the strip, the update commands set its base colors
+# and the animations are layers on top of them
+compositor = make_compositor(layout, num_pixels, output=make_output(num_pixels, budget_ma=psu_budget_ma))
+animation_state["compositor"] = compositor
+
+# The last binary frame from the server (see frames.py)
+frame_stream = make_frame_stream(num_pixels)
+
+
+# Status reports to the server
+# Instead of all LED states after every command, the LEDs that changed are collected and sent
+# together at most every status_interval seconds. Every report has a sequence number that the
+# server sends back in an "ack" message, the LEDs of reports that are not acked in time are sent again
+status_interval = 0.1
+ack_timeout = 2.0
+status_report = {
+    "seq": 0,
+    "changed": set(),
+    "commands": 0,
+    "failed": 0,
+    "unacked": {},  # seq: (time sent, LED IDs)
+    "wake": None    # asyncio.Event, made when the reporter starts
+}
+
+# Wakes the reporter, there is something new to report
+def wake_reporter():
+    if status_report["wake"] is not None:
+        status_report["wake"].set()
+
+# Counts a command for the next report
+def report_command(success):
+    status_report["commands"] += 1
+    if not success:
+        status_report["failed"] += 1
+    wake_reporter()
+
+# The server got a report
+def receive_ack(seq):
+    for sent in [sent for sent in status_report["unacked"] if sent <= seq]:
+        del status_report["unacked"][sent]
+
+# Makes the next report, or None if there is nothing to report
+def next_status_report():
+    now = time.monotonic()
+    for seq, (sent_at, led_ids) in list(status_report["unacked"].items()):
+        if now - sent_at > ack_timeout:
+            status_report["changed"] |= led_ids
+            del status_report["unacked"][seq]
+
+    changed = status_report["changed"]
+    if not changed and not status_report["commands"]:
+        return None
+
+    status_report["seq"] += 1
+    message = {
+        "type": "status",
+        "seq": status_report["seq"],
+        "success": status_report["failed"] == 0,
+        "commands": status_report["commands"],
+        "states": {led_id: led_states[led_id] for led_id in changed},
+        "power": dict(compositor["output"]["power"]),
+        "commands_queue": command_metrics(compositor),
+        "frames": frame_metrics(compositor)
+    }
+    status_report["unacked"][status_report["seq"]] = (now, changed)
+    status_report["changed"] = set()
+    status_report["commands"] = 0
+    status_report["failed"] = 0
+    return message
+
+# Sends the status reports while connected
+# The JSON is made in another thread, so the event loop keeps handling commands
+async def report_status(websocket):
+    status_report["wake"] = wake = asyncio.Event()
+    status_report["changed"].clear()
+    status_report["unacked"].clear()
+    while True:
+        try:
+            await asyncio.wait_for(wake.wait(), timeout=ack_timeout)
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+        # Everything that happens in the next status_interval goes into the same report
+        await asyncio.sleep(status_interval)
+
+        message = next_status_report()
+        if message is not None:
+            await websocket.send(await asyncio.to_thread(json.dumps, message))
+
+# The server
+server_address = "95.179.138.135:80"
+
+# One HTTP session for all requests, so the connection to the server is kept open (keep-alive)
+# A Session can't be used by two threads at once, and a cancelled asyncio.to_thread keeps running,
+# so every request takes the lock first
+http_session = requests.Session()
+http_lock = threading.Lock()
+http_timeout = 2.0
+
+# Time between reconnects, it doubles after every failed try up to the max
+# The delay only starts over when the connection worked: a message arrived, or it stayed open
+# for stable_connection_time seconds (a server that accepts and drops right away still backs off)
+reconnect_delay = 0.5
+max_reconnect_delay = 30.0
+stable_connection_time = 10.0
 
 # Gets the initial LED states from server via HTTP request (not ws, could not get it to work)
 # Server returns a dictionary with LED IDs as keys and colors as values.
 # Very good example: {"0": "#FF0000", "1": "#00FF00"}
+# It blocks, so call it with asyncio.to_thread from the event loop
 def get_initial_states():
     try:
-        response = requests.get('http://95.179.138.135:80/api/getStates')
+        with http_lock:
+            response = http_session.get(f'http://{server_address}/api/getStates', timeout=http_timeout)
         if response.status_code == 200:
             states = response.json()
             return states
@@ -66,19 +197,105 @@ def get_initial_states():
 
 # Applys color to LED
 async def apply_led_state(led_id, color):
+    return apply_led_states([led_id], [color])
+
+# Decodes a list of hex colors ("#ff0000") or one string of hex colors ("ff000000ff00...")
+# all at once, returns a (N, 3) array in GBR order (like the strip wants)
+# Every color must be exactly 6 hex digits (after the #), otherwise the whole command is rejected
+def decode_hex_colors(colors):
+    if not isinstance(colors, str):
+        digits = []
+        for color in colors:
+            if not is_hex_color(color):
+                raise ValueError(f"Invalid color {color!r}, it must be 6 hex digits")
+            digits.append(color[1:] if color.startswith('#') else color)
+        colors = "".join(digits)
+    elif len(colors) % 6:
+        raise ValueError("Colors must be 6 hex digits each")
+
+    data = bytes.fromhex(colors)
+    # fromhex skips spaces, so the length shows if there was anything that isn't a hex digit
+    if len(data) * 2 != len(colors):
+        raise ValueError("Colors must only have hex digits")
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)[:, [1, 2, 0]]
+
+# True if color is a string with 6 hex digits, with or without a # in front ("#ff0000" or "ff0000")
+def is_hex_color(color):
+    if not isinstance(color, str):
+        return False
+    digits = color[1:] if color.startswith('#') else color
+    return len(digits) == 6 and all(digit in string.hexdigits for digit in digits)
+
+# Applies many LED colors at once, they are shown together in the next frame
+# colors is a list of hex colors or one string of hex colors (same as decode_hex_colors)
+def apply_led_states(led_ids, colors):
     try:
-        # Make the hex colors RGB
-        color = color.lstrip('#')
-        r = int(color[0:2], 16)
-        g = int(color[2:4], 16)
-        b = int(color[4:6], 16)
-        
-        # RGB to GBR....
-        pixels[led_id] = (g, b, r)  # GBR order
-        pixels.show()
-        led_states[str(led_id)] = '#' + color
+        led_ids = np.asarray(led_ids, dtype=np.intp).reshape(-1)
+        gbr = decode_hex_colors(colors)
+        if len(gbr) != len(led_ids):
+            raise ValueError(f"{len(led_ids)} LEDs but {len(gbr)} colors")
+        if len(led_ids) and (led_ids.min() < 0 or led_ids.max() >= num_pixels):
+            raise ValueError("LED index out of range")
+
+        set_base_colors(compositor, led_ids, gbr)
+        store_led_states(led_ids, gbr[:, [2, 0, 1]])
+        return True
     except Exception as e:
-        print(f"Error applying LED state: {e}")
+        print(f"Error applying LED states: {e}")
+        return False
+
+# Saves the colors (a (N, 3) RGB array) in led_states as hex colors
+def store_led_states(led_ids, rgb):
+    hex_colors = np.ascontiguousarray(rgb, dtype=np.uint8).tobytes().hex()
+    changed = status_report["changed"]
+    for i, led_id in enumerate(np.asarray(led_ids).tolist()):
+        led_states[str(led_id)] = '#' + hex_colors[i * 6:i * 6 + 6]
+        changed.add(str(led_id))
+    wake_reporter()
+
+# Applies the states from the server as one bulk update
+# A LED with a bad ID or color is skipped, so one bad state doesn't stop the others from being restored
+def apply_initial_states(states):
+    led_ids = []
+    colors = []
+    skipped = []
+    for led_id, color in states.items():
+        try:
+            led_id = int(led_id)
+        except ValueError:
+            continue
+        if not 0 <= led_id < num_pixels:
+            continue
+        if not is_hex_color(color):
+            skipped.append(led_id)
+            continue
+        led_ids.append(led_id)
+        colors.append(color)
+    if skipped:
+        print(f"Skipped the initial states of LEDs {skipped}, their colors are not 6 hex digits")
+    return apply_led_states(led_ids, colors)
+
+# How long to wait before reconnecting, exponential backoff with jitter
+# so many clients don't all reconnect at the same moment
+def next_reconnect_delay(attempt):
+    delay = min(reconnect_delay * 2 ** attempt, max_reconnect_delay)
+    return random.uniform(delay / 2, delay)
+
+# Applies a binary frame from the server (a websocket message that is bytes, not JSON)
+def apply_binary_frame(message):
+    try:
+        received = receive_frame(frame_stream, message)
+    except ValueError as e:
+        print(f"Invalid binary frame: {e}")
+        return False
+    if received is None:
+        return False
+
+    first, rgb = received
+    led_ids = np.arange(first, first + len(rgb))
+    set_base_colors(compositor, led_ids, rgb[:, [1, 2, 0]])  # RGB to GBR
+    store_led_states(led_ids, rgb)
+    return True
 
 # Handle incoming commands
 async def handle_command(command):
@@ -88,13 +305,36 @@ async def handle_command(command):
         led_id = command.get('led')
         color = command.get('color', '#000000')
         if led_id is not None:
-            await apply_led_state(led_id, color)
-            return True
+            return await apply_led_state(led_id, color)
 
     elif cmd_type == 'updateAll':
         color = command.get('color', '#000000')
-        for i in range(num_pixels):
-            await apply_led_state(i, color)
+        return apply_led_states(range(num_pixels), [color] * num_pixels)
+
+    # Many LEDs in one command: {"type": "batch", "leds": [0, 5], "colors": ["#ff0000", "#00ff00"]}
+    elif cmd_type == 'batch':
+        return apply_led_states(command.get('leds', []), command.get('colors', []))
+
+    # A whole frame as one hex string, LED 0 first: {"type": "frame", "frame": "ff000000ff00..."}
+    elif cmd_type == 'frame':
+        frame = command.get('frame', '')
+        # Anything but a string (a number, null, a list) is a bad command, not a dropped connection
+        if not isinstance(frame, str):
+            print(f"Error in frame command: frame must be a hex string, not {type(frame).__name__}")
+            return False
+        return apply_led_states(range(len(frame) // 6), frame)
+
+    # A short flash over all LEDs, on top of the animations: {"type": "flash", "color": "#ffffff", "duration": 0.2}
+    elif cmd_type == 'flash':
+        try:
+            color = decode_hex_colors([command.get('color', '#ffffff')])[0]
+            duration = float(command.get('duration', 0.2))
+            if not 0 < duration <= max_flash_duration:
+                raise ValueError(f"Flash duration must be between 0 and {max_flash_duration} seconds")
+        except Exception as e:
+            print(f"Error in flash command: {e}")
+            return False
+        flash(compositor, color, duration)
         return True
 
     elif cmd_type == 'animation':
@@ -102,39 +342,49 @@ async def handle_command(command):
         name = command.get('name')
 
         if action == 'start':
-            if name == 'snow':
-                return start_snow(pixels, led_positions, animation_state)
-            elif name == 'spiral':
-                return start_spiral(pixels, led_positions, animation_state)
-            elif name in ['rain', 'lightning', 'clear']:
-                return start_weather_animation(pixels, led_positions, animation_state, name)
+            # The new animation replaces the running one with a transition ("fade", "wipe" or "cut")
+            transition = command.get('transition', 'fade')
+            try:
+                duration = float(command.get('duration', 1.0))
+                if not isinstance(transition, str) or not 0 <= duration <= max_transition_duration:
+                    raise ValueError(f"Transition must be a name and last 0 to {max_transition_duration} seconds")
+            except Exception as e:
+                print(f"Error in animation command: {e}")
+                return False
+            # Pre-rendered clips play from a file instead of running the effect live
+            if command.get('baked'):
+                return start_clip(pixels, layout, animation_state, name, command.get('params'),
+                                  transition=transition, duration=duration)
+            if name in effects:
+                return switch_effect(pixels, layout, animation_state, name, transition, duration)
         elif action == 'stop':
-            stop_all_animations(pixels, animation_state)
+            # Stop only that animation if it is running, otherwise everything
+            # (the website stops the weather animation as "weather")
+            if not stop_animation(pixels, animation_state, name):
+                stop_all_animations(pixels, animation_state)
             return True
 
     return False
 
 async def connect_to_server():
-    uri = "ws://95.179.138.135:80/ws"
-    
+    uri = f"ws://{server_address}/ws"
+    attempt = 0
+
     while True:
+        # Get the states of the LEDs while the websocket connects, in another thread
+        initial_states = asyncio.create_task(asyncio.to_thread(get_initial_states))
         try:
-            # Use the initial states of the LEDs before websocket connection
-            initial_states = get_initial_states()
-            for led_id_str, color in initial_states.items():
-                try:
-                    led_id = int(led_id_str)
-                    await apply_led_state(led_id, color)
-                except ValueError:
-                    continue
-
             async with websockets.connect(uri) as websocket:
                 print("Connected to server")
+                connected_at = time.monotonic()
+
+                # All LEDs at once, they are shown together in the next frame
+                apply_initial_states(await initial_states)
                 
                 # Send LED positions
                 positions_message = {
                     "type": "positions",
-                    "positions": json.dumps(led_positions) if led_positions else "[]"
+                    "positions": positions_json
                 }
                 await websocket.send(json.dumps(positions_message))
 
@@ -145,42 +395,60 @@ async def connect_to_server():
                 }
                 await websocket.send(json.dumps(states_message))
 
-                while True:
-                    try:
-                        msg = await websocket.recv()
-                        command = json.loads(msg)
-
-                        success = await handle_command(command)
-                        
-                        # Send status update
-                        await websocket.send(json.dumps({
-                            "type": "status",
-                            "success": success,
-                            "states": led_states
-                        }))
-                                
-                    except json.JSONDecodeError as e:
-                        print(f"Invalid JSON received: {e}")
-                        continue
+                # The states were just sent, the reporter only sends what changes from now on
+                reporter = asyncio.create_task(report_status(websocket))
+                try:
+                    while True:
+                        try:
+                            msg = await websocket.recv()
+                            attempt = 0
+
+                            # Binary frames are streamed, their changes go in the next status report
+                            if isinstance(msg, bytes):
+                                apply_binary_frame(msg)
+                                continue
+
+                            command = json.loads(msg)
+                            if command.get('type') == 'ack':
+                                receive_ack(command.get('seq', 0))
+                                continue
+
+                            report_command(await handle_command(command))
+
+                        except json.JSONDecodeError as e:
+                            print(f"Invalid JSON received: {e}")
+                            continue
+                finally:
+                    reporter.cancel()
+                    status_report["wake"] = None
+                    if time.monotonic() - connected_at >= stable_connection_time:
+                        attempt = 0
 
         except websockets.ConnectionClosed:
             print("Connection lost, reconnecting...")
-            # Try to connect again after 5 seconds
-            await asyncio.sleep(5)
         except Exception as e:
             print(f"Error: {e}")
-            await asyncio.sleep(5)
+        finally:
+            initial_states.cancel()
+
+        # Try to connect again, waiting longer after every failed try
+        delay = next_reconnect_delay(attempt)
+        attempt += 1
+        print(f"Reconnecting in {delay:.1f} seconds")
+        await asyncio.sleep(delay)
 
 if __name__ == "__main__":
     try:
         # Clear all LEDs on startup
         pixels.fill((0, 0, 0))
         pixels.show()
+        start_compositor(pixels, compositor)
 
         # Start websocket client
         asyncio.get_event_loop().run_until_complete(connect_to_server())
     except KeyboardInterrupt:
         # Clear LEDs on exit
         stop_all_animations(pixels, animation_state)
+        stop_compositor(compositor)
         pixels.fill((0, 0, 0))
         pixels.show()
\ No newline at end of file
@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import zlib
+import struct
+import asyncio
+import hashlib
+import threading
+import numpy as np
+from animations import effects, target_fps, start_render
+from compositor import transitions
+
+# Pre-rendered animation clips
+# An effect is rendered once into a clip file (frames x LEDs x 3 uint8, same order as layout["ids"])
+# and played back from the file, so no effect code (or random calls) runs while it plays
+#
+# Clip file (little-endian):
+#   header (32 bytes): magic "DDUC", version, compression, frame count, LED count, fps, data offset
+#   data: the frames, raw (compression 0) or XOR delta to the frame before and zlib (compression 1)
+CLIP_MAGIC = b"DDUC"
+CLIP_VERSION = 1
+CLIP_HEADER_FORMAT = "<4sHHIIfI8x"
+CLIP_HEADER_SIZE = struct.calcsize(CLIP_HEADER_FORMAT)
+
+COMPRESSION_NONE = 0
+COMPRESSION_DELTA = 1
+
+# Where the clips are saved, and how much disk they may use before the oldest are deleted
+clips_folder = '../data/clips'
+max_cache_bytes = 64 * 1024 * 1024
+
+# Only one clip is baked at a time, so two bakes never write the same file
+bake_lock = threading.Lock()
+
+# Hash of the LED positions, so a clip is made again when the layout changes
+def layout_hash(layout):
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(layout["ids"], dtype="<u4").tobytes())
+    sha.update(np.ascontiguousarray(layout["xyz"], dtype="<f4").tobytes())
+    return sha.hexdigest()
+
+# The clip file name for an effect, its parameters, the layout and how the file is compressed
+def clip_key(name, params, layout, seconds, fps, compression=COMPRESSION_NONE):
+    description = json.dumps({"name": name, "params": params, "seconds": seconds, "fps": fps,
+                              "compression": compression}, sort_keys=True)
+    sha = hashlib.sha1(description.encode())
+    sha.update(layout_hash(layout).encode())
+    return sha.hexdigest()
+
+def clip_path(key, folder=clips_folder):
+    return os.path.join(folder, f"{key}.clip")
+
+# Renders seconds of an effect at fps, with the same t and dt the render loop would give
+# Returns a (frames, LEDs, 3) uint8 array
+def render_clip(name, layout, params, seconds, fps):
+    render = effects[name](layout, **params)
+    count = max(int(round(seconds * fps)), 1)
+    frames = np.zeros((count, len(layout["ids"]), 3), dtype=np.uint8)
+    for i in range(count):
+        render(i / fps, 1.0 / fps, frames[i])
+    return frames
+
+# Writes a clip file, through a temporary file so a half written clip is never played
+def write_clip(path, frames, fps, compression=COMPRESSION_NONE):
+    if compression == COMPRESSION_DELTA:
+        delta = frames.copy()
+        delta[1:] ^= frames[:-1]
+        data = zlib.compress(delta.tobytes(), 6)
+    else:
+        data = np.ascontiguousarray(frames).tobytes()
+
+    header = struct.pack(CLIP_HEADER_FORMAT, CLIP_MAGIC, CLIP_VERSION, compression,
+                         frames.shape[0], frames.shape[1], fps, CLIP_HEADER_SIZE)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(header)
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+# Loads a clip file
+# Raw clips are memory-mapped, compressed clips are unpacked into memory once
+# Returns a dict with frames (frames, LEDs, 3) and fps
+def load_clip(path):
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    if len(data) < CLIP_HEADER_SIZE:
+        raise ValueError(f"{path} is too small to be a clip file")
+
+    magic, version, compression, count, leds, fps, offset = struct.unpack_from(CLIP_HEADER_FORMAT, data)
+    if magic != CLIP_MAGIC:
+        raise ValueError(f"{path} is not a clip file")
+    if version != CLIP_VERSION:
+        raise ValueError(f"Unsupported clip version {version} in {path}")
+
+    if compression == COMPRESSION_DELTA:
+        delta = np.frombuffer(zlib.decompress(data[offset:]), dtype=np.uint8).reshape(count, leds, 3)
+        frames = np.bitwise_xor.accumulate(delta, axis=0)
+    elif compression == COMPRESSION_NONE:
+        frames = np.frombuffer(data, dtype=np.uint8, count=count * leds * 3, offset=offset).reshape(count, leds, 3)
+    else:
+        raise ValueError(f"Unknown clip compression {compression} in {path}")
+
+    return {"frames": frames, "fps": fps, "path": path}
+
+# Deletes the least recently used clips until the folder is under max_bytes
+# (playing a clip updates its modification time)
+def evict_clips(folder=clips_folder, max_bytes=max_cache_bytes, keep=None):
+    if not os.path.isdir(folder):
+        return 0
+    clips = []
+    for file_name in os.listdir(folder):
+        if file_name.endswith(".clip"):
+            path = os.path.join(folder, file_name)
+            stat = os.stat(path)
+            clips.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in clips)
+    removed = 0
+    for _, size, path in sorted(clips):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        os.remove(path)
+        total -= size
+        removed += 1
+    return removed
+
+# Loads the clip for an effect, or renders and saves it first if it is not in the cache
+def get_clip(name, layout, params=None, seconds=10.0, fps=target_fps,
+             compression=COMPRESSION_NONE, folder=clips_folder):
+    # A clip always has a seed, so baking it again gives the same frames
+    params = dict({"seed": 0}, **(params or {}))
+    path = clip_path(clip_key(name, params, layout, seconds, fps, compression), folder)
+
+    if os.path.exists(path):
+        os.utime(path)
+    else:
+        write_clip(path, render_clip(name, layout, params, seconds, fps), fps, compression)
+        evict_clips(folder, keep=path)
+    return load_clip(path)
+
+# Render function that plays a clip in the render loop, looping at the end
+# It only copies one row of the clip into the frame
+def make_clip_effect(clip):
+    frames = clip["frames"]
+    fps = clip["fps"]
+
+    def render(t, dt, frame):
+        frame[:] = frames[int(t * fps + 0.5) % len(frames)]
+
+    return render
+
+# Starts an effect from its clip instead of rendering it live
+# Baking a clip can take seconds, so it is baked (or loaded) on its own thread,
+# and the writer thread only gets the loaded clip when it is ready (the strip never freezes)
+# The loaded clip is handed back to the event loop, so the layers and the state are only changed there.
+# The clip only starts if it wasn't stopped or replaced while it was baking
+# (state["pending_clips"] has a token for each clip that is baking, stop and switch remove them)
+# Returns True if the clip is being started
+def start_clip(pixels, layout, state, name, params=None, seconds=10.0, transition=None, duration=1.0):
+    if name not in effects or (transition is not None and transition not in transitions):
+        return False
+    if params is not None and not isinstance(params, dict):
+        return False
+
+    token = object()
+    state["pending_clips"][name] = token
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    # Runs in the event loop when the bake is done (clip is None if it failed)
+    def finish(clip):
+        if state["pending_clips"].get(name) is not token:
+            return
+        del state["pending_clips"][name]
+        if clip is not None and not start_render(pixels, layout, state, name, lambda: make_clip_effect(clip),
+                                                 transition=transition, duration=duration):
+            print(f"Clip {name} is baked but could not be started (already running?)")
+
+    def bake():
+        clip = None
+        try:
+            with bake_lock:
+                clip = get_clip(name, layout, params, seconds, target_fps)
+        except Exception as e:
+            print(f"Error baking clip {name}: {e}")
+        if loop is None:
+            finish(clip)
+        else:
+            loop.call_soon_threadsafe(finish, clip)
+
+    threading.Thread(target=bake, daemon=True).start()
+    return True
+
+if __name__ == "__main__":
+    # Bakes the clips ahead of time, e.g. python clips.py ../data/led_layout.bin rain snow spiral
+    from layout import load_layout
+    if len(sys.argv) < 3:
+        print("Usage: python clips.py <layout.bin> <effect> [<effect> ...]")
+        sys.exit(1)
+    layout = load_layout(sys.argv[1])
+    for name in sys.argv[2:]:
+        clip = get_clip(name, layout)
+        print(f"{name}: {len(clip['frames'])} frames in {clip['path']}")
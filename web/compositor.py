@@ -0,0 +1,387 @@
+import time
+import threading
+from collections import deque
+import numpy as np
+from output import make_output, apply_output, write_output
+
+# Compositor that owns the LED strip
+# Everything that wants to change the LEDs draws into a layer, and one writer thread
+# blends the layers together and writes the strip once per frame:
+#   base:       the colors from the update commands (led_states), in strip order
+#   animations: one layer per running effect, in the order they were started
+#   flash:      short flashes on top of everything, removed when they run out
+# Colors are GBR like the strip, and 0 to 1 floats while blending
+#
+# The asyncio client never touches the layers or the strip. Commands that must all happen in
+# order ("add this layer", "remove that layer", ...) are appended to a deque, which the writer
+# empties at the start of every frame. deque.append and popleft are atomic, so there are no locks
+# and nothing that can block the event loop. Base colors go in a table with the latest color
+# of each LED instead, so when a LED is changed many times between two frames only the last
+# color is used (the others are counted as superseded). The writer composes into a back buffer
+# and swaps it with the front buffer, the output stage and get_current_colors only read the
+# front buffer, so they always see a whole frame.
+
+# Frames per second of the writer
+target_fps = 30
+
+# Layers are drawn in this order (lowest first)
+ANIMATION_LAYER = 1
+FLASH_LAYER = 2
+
+# Blend modes, out and src are (N, 3) colors from 0 to 1
+# over uses the brightness of each LED as its alpha (the colors count as premultiplied),
+# so the black parts of an effect let the layers below show through
+def blend_over(out, src, opacity):
+    alpha = src.max(axis=1, keepdims=True) * opacity
+    out *= 1.0 - alpha
+    out += src * opacity
+
+def blend_add(out, src, opacity):
+    out += src * opacity
+
+def blend_max(out, src, opacity):
+    np.maximum(out, src * opacity, out=out)
+
+def blend_multiply(out, src, opacity):
+    out *= 1.0 - opacity + src * opacity
+
+blend_modes = {
+    "over": blend_over,
+    "add": blend_add,
+    "max": blend_max,
+    "multiply": blend_multiply
+}
+
+# Makes a compositor for a layout and a strip with num_pixels LEDs
+# output is the output stage from output.py (gamma and dithering), a default one is made if it is None
+def make_compositor(layout, num_pixels, fps=target_fps, output=None):
+    ids = np.asarray(layout["ids"], dtype=np.intp)
+    on_strip = ids < num_pixels
+    return {
+        "num_pixels": num_pixels,
+        "fps": fps,
+        "ids": ids[on_strip],
+        "on_strip": on_strip,
+        "layout_size": len(ids),
+        # Height of each layout LED (0 bottom, 1 top), for the wipe transition
+        "height": np.asarray(layout["cylindrical"][:, 1], dtype=np.float32),
+        "intents": deque(),
+        # Latest base color of each LED from the client side, and which LEDs changed since the last frame
+        "base_target": np.zeros((num_pixels, 3), dtype=np.float32),
+        "base_dirty": np.zeros(num_pixels, dtype=bool),
+        "metrics": {
+            "max_queue_depth": 0,
+            "base_updates": 0,
+            "superseded": 0,
+            # Intents, layers and frames the writer dropped because they raised an error
+            "failed_intents": 0,
+            "failed_layers": 0,
+            "failed_frames": 0
+        },
+        "last_error": None,
+        # Names of the animation layers that were asked for, only used by the client side
+        "names": [],
+        # Only used by the writer thread
+        "base": np.zeros((num_pixels, 3), dtype=np.float32),
+        "layers": [],
+        # The last whole frame, and the one being composed (colors from 0 to 1)
+        "front": np.zeros((num_pixels, 3), dtype=np.float32),
+        "back": np.zeros((num_pixels, 3), dtype=np.float32),
+        "clock": 0.0,
+        "is_running": False,
+        "thread": None,
+        "frames": 0,
+        "dropped_frames": 0,
+        "output": output if output is not None else make_output(num_pixels)
+    }
+
+# Puts base colors in the table, a LED that already had a color waiting gets the new one
+# The color is written before the LED is marked, so the writer never misses a change
+def update_base(compositor, led_ids, colors):
+    dirty = compositor["base_dirty"]
+    metrics = compositor["metrics"]
+    ids = np.asarray(led_ids, dtype=np.intp).reshape(-1)
+    unique_ids = np.unique(ids)
+
+    # Superseded colors: a LED that is more than once in this update (only the last color is used),
+    # and a LED that still had a color waiting. Only the LEDs in this update are read, before they
+    # are marked, so the writer clearing other LEDs at the same time doesn't change the count
+    superseded = len(ids) - len(unique_ids) + int(np.count_nonzero(dirty[unique_ids]))
+
+    compositor["base_target"][ids] = np.asarray(colors, dtype=np.float32) / 255.0
+    dirty[ids] = True
+
+    metrics["base_updates"] += len(ids)
+    metrics["superseded"] += superseded
+
+# Sets the base colors of many LEDs at once, colors is (N, 3) GBR from 0 to 255
+def set_base_colors(compositor, led_ids, colors):
+    update_base(compositor, np.asarray(led_ids, dtype=np.intp), colors)
+
+# Copies the base colors that changed from the table, only called by the writer
+def apply_base(compositor):
+    dirty = compositor["base_dirty"]
+    changed = np.flatnonzero(dirty)
+    if len(changed):
+        dirty[changed] = False
+        compositor["base"][changed] = compositor["base_target"][changed]
+
+# How the commands are doing, for monitoring
+# queue_depth is how many ordered commands are waiting, pending_leds how many base colors are waiting
+def command_metrics(compositor):
+    return dict(compositor["metrics"],
+                queue_depth=len(compositor["intents"]),
+                pending_leds=int(np.count_nonzero(compositor["base_dirty"])))
+
+# How the writer keeps up, for monitoring
+# frames is how many frames were shown, dropped_frames how many were skipped because the writer was too late
+def frame_metrics(compositor):
+    return {
+        "frames": compositor["frames"],
+        "dropped_frames": compositor["dropped_frames"]
+    }
+
+# Adds a layer, make_render() returns a render(t, dt, frame) function like the effects in animations.py
+# make_render is called by the writer, so making the effect doesn't block the caller either
+# t starts at 0 when the layer is added, duration (seconds) removes the layer by itself
+def add_layer(compositor, name, make_render, blend="over", opacity=1.0, duration=None, level=ANIMATION_LAYER):
+    if blend not in blend_modes:
+        raise ValueError(f"Unknown blend mode {blend}")
+    if level == ANIMATION_LAYER:
+        compositor["names"] = [old for old in compositor["names"] if old != name] + [name]
+    compositor["intents"].append(("add", {
+        "name": name,
+        "make_render": make_render,
+        "blend": blend_modes[blend],
+        "opacity": float(opacity),
+        "level": level,
+        "duration": duration
+    }))
+
+# Replaces all animation layers with a new one, with a transition from the old ones
+# transition is "fade" (cross-fade), "wipe" (the new effect comes down from the top) or "cut"
+def switch_layer(compositor, name, make_render, blend="over", opacity=1.0, transition="fade", duration=1.0):
+    if blend not in blend_modes:
+        raise ValueError(f"Unknown blend mode {blend}")
+    if transition not in transitions:
+        raise ValueError(f"Unknown transition {transition}")
+    # Checked here, the writer compares it with numbers and would fail on every frame
+    duration = float(duration)
+    if not duration >= 0:
+        raise ValueError(f"Transition duration must be 0 or more, got {duration}")
+    compositor["names"] = [name]
+    compositor["intents"].append(("switch", {
+        "name": name,
+        "make_render": make_render,
+        "blend": blend_modes[blend],
+        "opacity": float(opacity),
+        "level": ANIMATION_LAYER,
+        "duration": None
+    }, transition, duration))
+
+# Removes an animation layer by name, or all animation layers when name is None
+# Returns how many layers are removed
+def remove_layers(compositor, name=None):
+    names = compositor["names"]
+    removed = [old for old in names if name is None or old == name]
+    compositor["names"] = [old for old in names if old not in removed]
+    if removed:
+        compositor["intents"].append(("remove", removed))
+    return len(removed)
+
+# Names of the running animation layers
+def layer_names(compositor):
+    return list(compositor["names"])
+
+# Flashes a color over all LEDs for duration seconds
+def flash(compositor, color, duration=0.2, blend="over", opacity=1.0):
+    color = np.asarray(color, dtype=np.uint8)
+
+    def render(t, dt, frame):
+        frame[:] = color
+
+    add_layer(compositor, "flash", lambda: render, blend, opacity, duration, FLASH_LAYER)
+
+# How much of the new frame each LED shows, p goes from 0 to 1 during the transition
+def fade_weights(compositor, p):
+    return np.float32(p)
+
+def wipe_weights(compositor, p, edge=0.2):
+    return np.clip((p * (1 + edge) - (1 - compositor["height"])) / edge, 0.0, 1.0)[:, np.newaxis]
+
+transitions = {
+    "fade": fade_weights,
+    "wipe": wipe_weights,
+    "cut": None
+}
+
+# Mixes the frames of the outgoing layers into the frame of a layer that is switching in
+def mix_transition(compositor, layer, t, dt):
+    transition = layer["transition"]
+    p = (t - transition["start"]) / transition["duration"]
+    if p >= 1:
+        del layer["transition"]
+        return
+
+    # The outgoing layers are drawn together (brightest wins), then interpolated with the new frame
+    outgoing = transition["frame"]
+    outgoing[:] = 0
+    for old in transition["outgoing"]:
+        old["render"](t - old["start"], dt, old["frame"])
+        np.maximum(outgoing, old["frame"], out=outgoing)
+
+    weights = transitions[transition["kind"]](compositor, p)
+    mixed = outgoing + (layer["frame"] - outgoing.astype(np.float32)) * weights
+    np.rint(mixed, out=mixed)
+    layer["frame"][:] = mixed
+
+# Makes a layer from its spec when the writer gets it
+def make_layer(compositor, spec, t):
+    try:
+        render = spec["make_render"]()
+    except Exception as e:
+        print(f"Error starting layer {spec['name']}: {e}")
+        return None
+    return dict(spec, render=render, start=t,
+                end=t + spec["duration"] if spec["duration"] is not None else None,
+                frame=np.zeros((compositor["layout_size"], 3), dtype=np.uint8),
+                strip=np.zeros((compositor["num_pixels"], 3), dtype=np.float32))
+
+# Does one intent from the client side, only called by the writer
+def apply_intent(compositor, intent, t):
+    kind = intent[0]
+    if kind == "add":
+        layer = make_layer(compositor, intent[1], t)
+        if layer is None:
+            return
+        layers = [old for old in compositor["layers"]
+                  if not (old["name"] == layer["name"] and old["level"] == layer["level"])]
+        compositor["layers"] = sorted(layers + [layer], key=lambda l: l["level"])
+    elif kind == "switch":
+        _, spec, transition, duration = intent
+        layer = make_layer(compositor, spec, t)
+        if layer is None:
+            return
+        outgoing = [old for old in compositor["layers"] if old["level"] == ANIMATION_LAYER]
+        if outgoing and transitions[transition] is not None and duration > 0:
+            layer["transition"] = {
+                "kind": transition,
+                "start": t,
+                "duration": duration,
+                # A layer that was still switching in counts as fully switched in
+                "outgoing": [{key: value for key, value in old.items() if key != "transition"}
+                             for old in outgoing],
+                "frame": np.zeros((compositor["layout_size"], 3), dtype=np.uint8)
+            }
+        layers = [old for old in compositor["layers"] if old["level"] != ANIMATION_LAYER]
+        compositor["layers"] = sorted(layers + [layer], key=lambda l: l["level"])
+    elif kind == "remove":
+        names = intent[1]
+        compositor["layers"] = [layer for layer in compositor["layers"]
+                                if layer["level"] != ANIMATION_LAYER or layer["name"] not in names]
+
+# Does the waiting intents and blends all layers for time t into the back buffer,
+# then swaps the buffers, returns the new front buffer
+def compose(compositor, t, dt):
+    compositor["clock"] = t
+    intents = compositor["intents"]
+    metrics = compositor["metrics"]
+    metrics["max_queue_depth"] = max(metrics["max_queue_depth"], len(intents))
+    while intents:
+        intent = intents.popleft()
+        try:
+            apply_intent(compositor, intent, t)
+        except Exception as e:
+            # One bad intent is dropped, the others still happen
+            metrics["failed_intents"] += 1
+            report_error(compositor, f"Error in {intent[0]} intent: {e}")
+    apply_base(compositor)
+
+    layers = compositor["layers"]
+    if any(layer["end"] is not None and t >= layer["end"] for layer in layers):
+        layers = [layer for layer in layers if layer["end"] is None or t < layer["end"]]
+        compositor["layers"] = layers
+
+    ids = compositor["ids"]
+    on_strip = compositor["on_strip"]
+    out = compositor["back"]
+    out[:] = compositor["base"]
+    failed = []
+    for layer in layers:
+        try:
+            layer["render"](t - layer["start"], dt, layer["frame"])
+            if "transition" in layer:
+                mix_transition(compositor, layer, t, dt)
+        except Exception as e:
+            failed.append(layer)
+            report_error(compositor, f"Error rendering layer {layer['name']}, it is removed: {e}")
+            continue
+        layer["strip"][ids] = layer["frame"][on_strip] * (1.0 / 255.0)
+        layer["blend"](out, layer["strip"], layer["opacity"])
+
+    # A layer that raised is removed, so it doesn't stop every frame after it
+    if failed:
+        metrics["failed_layers"] += len(failed)
+        compositor["layers"] = [layer for layer in layers if not any(layer is bad for bad in failed)]
+        names = {layer["name"] for layer in failed if layer["level"] == ANIMATION_LAYER}
+        compositor["names"] = [name for name in compositor["names"] if name not in names]
+
+    np.clip(out, 0.0, 1.0, out=out)
+    compositor["back"] = compositor["front"]
+    compositor["front"] = out
+    return out
+
+# Prints an error from the writer thread, the same error is only printed once in a row
+# (so a layer or strip that fails every frame doesn't print 30 times a second)
+def report_error(compositor, message):
+    if message != compositor["last_error"]:
+        print(message)
+    compositor["last_error"] = message
+
+# The writer, composes and writes a frame at a fixed frame rate
+# If a frame takes too long, the missed frames are skipped (and counted) instead of catching up
+# An error in a frame is printed and counted, and the writer goes on with the next frame
+def run_compositor(pixels, compositor):
+    frame_time = 1.0 / compositor["fps"]
+    start = time.monotonic() - compositor["clock"]
+    t = compositor["clock"]
+    dt = frame_time
+
+    while compositor["is_running"]:
+        try:
+            front = compose(compositor, t, dt)
+            output = compositor["output"]
+            write_output(pixels, output, apply_output(output, front))
+            compositor["frames"] += 1
+        except Exception as e:
+            compositor["metrics"]["failed_frames"] += 1
+            report_error(compositor, f"Error in compositor frame: {e}")
+
+        # Wait for the next frame, or skip the frames that are already too late
+        t += frame_time
+        dt = frame_time
+        delay = start + t - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            missed = int(-delay / frame_time)
+            compositor["dropped_frames"] += missed
+            t += missed * frame_time
+            dt += missed * frame_time
+
+# Starts the writer thread (does nothing if it is already running)
+def start_compositor(pixels, compositor):
+    if compositor["is_running"]:
+        return
+    compositor["is_running"] = True
+    compositor["thread"] = threading.Thread(target=run_compositor, args=(pixels, compositor), daemon=True)
+    compositor["thread"].start()
+
+# Stops the writer thread (only when the program stops, it waits for the thread)
+def stop_compositor(compositor):
+    compositor["is_running"] = False
+    if compositor["thread"]:
+        compositor["thread"].join()
+        compositor["thread"] = None
+    print(f"Compositor stopped after {compositor['frames']} frames, "
+          f"{compositor['dropped_frames']} dropped")
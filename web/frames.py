@@ -0,0 +1,83 @@
+import struct
+import numpy as np
+
+# Binary LED frames on the websocket, for streaming whole frames at 30-60 FPS
+# (a JSON message with hex colors is about 5 times bigger and much slower to decode)
+#
+# Message (little-endian):
+#   header (12 bytes): magic "LF", version, flags, first LED, LED count, sequence number
+#   data:              3 bytes per LED, RGB, LED first to first + count - 1
+# With the delta flag the data is XOR with the previous frame, so LEDs that didn't change are 0
+# and the message compresses well (a delta frame needs the frame right before it)
+FRAME_MAGIC = b"LF"
+FRAME_VERSION = 1
+FRAME_HEADER_FORMAT = "<2sBBHHI"
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FORMAT)
+
+FLAG_DELTA = 1
+
+# Makes a binary frame from a (N, 3) RGB uint8 array
+# With previous (the last frame that was sent, same shape) the frame is sent as a delta
+def encode_frame(rgb, sequence, first=0, previous=None):
+    rgb = np.ascontiguousarray(rgb, dtype=np.uint8).reshape(-1, 3)
+    flags = 0
+    if previous is not None:
+        rgb = rgb ^ np.asarray(previous, dtype=np.uint8).reshape(-1, 3)
+        flags |= FLAG_DELTA
+    header = struct.pack(FRAME_HEADER_FORMAT, FRAME_MAGIC, FRAME_VERSION, flags, first, len(rgb),
+                         sequence & 0xFFFFFFFF)
+    return header + rgb.tobytes()
+
+# Reads the header of a binary frame
+# Returns a dict with flags, first, count and sequence, and the data as a (count, 3) array
+# (the data points into the message, it is not copied)
+def decode_frame(message):
+    data = memoryview(message)
+    if len(data) < FRAME_HEADER_SIZE:
+        raise ValueError("Binary frame is too small")
+    magic, version, flags, first, count, sequence = struct.unpack_from(FRAME_HEADER_FORMAT, data)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Not a binary LED frame")
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported binary frame version {version}")
+    if len(data) != FRAME_HEADER_SIZE + count * 3:
+        raise ValueError(f"Binary frame should have {count * 3} bytes of data, got {len(data) - FRAME_HEADER_SIZE}")
+
+    return {
+        "flags": flags,
+        "first": first,
+        "count": count,
+        "sequence": sequence,
+        "rgb": np.frombuffer(data, dtype=np.uint8, count=count * 3, offset=FRAME_HEADER_SIZE).reshape(count, 3)
+    }
+
+# Keeps the last frame, so delta frames can be decoded
+def make_frame_stream(num_pixels):
+    return {
+        "rgb": np.zeros((num_pixels, 3), dtype=np.uint8),
+        "sequence": None,
+        "frames": 0,
+        "dropped": 0
+    }
+
+# Decodes a binary frame into the stream's frame
+# Returns the first LED and the new (count, 3) RGB colors, or None if the frame can't be used
+# (a delta frame that doesn't follow the last frame, it needs a whole frame first)
+def receive_frame(stream, message):
+    frame = decode_frame(message)
+    first = frame["first"]
+    end = first + frame["count"]
+    if end > len(stream["rgb"]):
+        raise ValueError(f"Binary frame goes to LED {end - 1}, the strip has {len(stream['rgb'])}")
+
+    if frame["flags"] & FLAG_DELTA:
+        if stream["sequence"] is None or frame["sequence"] != (stream["sequence"] + 1) & 0xFFFFFFFF:
+            stream["dropped"] += 1
+            return None
+        stream["rgb"][first:end] ^= frame["rgb"]
+    else:
+        stream["rgb"][first:end] = frame["rgb"]
+
+    stream["sequence"] = frame["sequence"]
+    stream["frames"] += 1
+    return first, stream["rgb"][first:end]
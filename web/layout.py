@@ -0,0 +1,233 @@
+import os
+import sys
+import struct
+import numpy as np
+
+# scipy is not always installed on the Pi, without it a voxel grid is used for the neighbour queries
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# Binary LED layout file
+# Faster to load than led_3d_coordinates.txt, the arrays are used straight from the file
+#
+# Layout (little-endian):
+#   header (48 bytes): magic "DDUL", version, header size, LED count,
+#                      offsets of the three arrays, bounding box min xyz and max xyz
+#   ids:        uint32[count]
+#   xyz:        float32[count, 3] in mm
+#   normalized: float32[count, 3], every axis from 0 to 1 over the bounding box
+LAYOUT_MAGIC = b"DDUL"
+LAYOUT_VERSION = 1
+HEADER_FORMAT = "<4sHHIIII6f"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# Arrays start on 16 byte boundaries
+def align(offset, boundary=16):
+    return (offset + boundary - 1) // boundary * boundary
+
+# Every axis from 0 to 1 over the bounding box
+# (an axis where all LEDs are at the same place is 0.5)
+def normalize_positions(xyz, bbox_min, bbox_max):
+    size = bbox_max - bbox_min
+    safe_size = np.where(size > 0, size, 1)
+    return np.where(size > 0, (xyz - bbox_min) / safe_size, 0.5).astype(np.float32)
+
+# The arrays of a layout from LED IDs and a Nx3 array of positions, sorted by LED ID
+def layout_arrays(ids, xyz):
+    order = np.argsort(ids)
+    ids = np.asarray(ids, dtype=np.uint32)[order]
+    xyz = np.asarray(xyz, dtype=np.float32).reshape(-1, 3)[order]
+
+    if len(ids):
+        bbox_min = xyz.min(axis=0)
+        bbox_max = xyz.max(axis=0)
+    else:
+        bbox_min = bbox_max = np.zeros(3, dtype=np.float32)
+    return {
+        "ids": ids,
+        "xyz": xyz,
+        "normalized": normalize_positions(xyz, bbox_min, bbox_max),
+        "bbox_min": bbox_min,
+        "bbox_max": bbox_max
+    }
+
+# Makes a layout in memory, the same as writing it to a file and loading it
+def make_layout(ids, xyz):
+    return prepare_layout(layout_arrays(ids, xyz))
+
+# Writes a layout file from LED IDs and a Nx3 array of positions
+def write_layout(path, ids, xyz):
+    arrays = layout_arrays(ids, xyz)
+    ids = arrays["ids"]
+    xyz = arrays["xyz"]
+    normalized = arrays["normalized"]
+    bbox_min = arrays["bbox_min"]
+    bbox_max = arrays["bbox_max"]
+    count = len(ids)
+
+    ids_offset = align(HEADER_SIZE)
+    xyz_offset = align(ids_offset + ids.nbytes)
+    normalized_offset = align(xyz_offset + xyz.nbytes)
+
+    header = struct.pack(HEADER_FORMAT, LAYOUT_MAGIC, LAYOUT_VERSION, HEADER_SIZE, count,
+                         ids_offset, xyz_offset, normalized_offset,
+                         *bbox_min.tolist(), *bbox_max.tolist())
+
+    with open(path, "wb") as f:
+        for offset, data in ((0, header), (ids_offset, ids.tobytes()),
+                             (xyz_offset, xyz.tobytes()), (normalized_offset, normalized.tobytes())):
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(data)
+
+# Loads a layout file without copying the arrays, they point into the memory-mapped file
+# Returns a dict with ids, xyz, normalized, bbox_min and bbox_max
+def load_layout(path):
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    if len(data) < HEADER_SIZE:
+        raise ValueError(f"{path} is too small to be a layout file")
+
+    (magic, version, header_size, count, ids_offset, xyz_offset, normalized_offset,
+     *bbox) = struct.unpack_from(HEADER_FORMAT, data)
+    if magic != LAYOUT_MAGIC:
+        raise ValueError(f"{path} is not a layout file")
+    if version != LAYOUT_VERSION:
+        raise ValueError(f"Unsupported layout version {version} in {path}")
+
+    return prepare_layout({
+        "ids": np.frombuffer(data, dtype="<u4", count=count, offset=ids_offset),
+        "xyz": np.frombuffer(data, dtype="<f4", count=count * 3, offset=xyz_offset).reshape(count, 3),
+        "normalized": np.frombuffer(data, dtype="<f4", count=count * 3, offset=normalized_offset).reshape(count, 3),
+        "bbox_min": np.array(bbox[:3], dtype=np.float32),
+        "bbox_max": np.array(bbox[3:], dtype=np.float32)
+    })
+
+# A layout without any LEDs, for when there is no layout file yet
+def empty_layout():
+    return prepare_layout({
+        "ids": np.zeros(0, dtype=np.uint32),
+        "xyz": np.zeros((0, 3), dtype=np.float32),
+        "normalized": np.zeros((0, 3), dtype=np.float32),
+        "bbox_min": np.zeros(3, dtype=np.float32),
+        "bbox_max": np.zeros(3, dtype=np.float32)
+    })
+
+# Adds everything the effects need to the layout, so it is only worked out once per layout
+# and all effects share it:
+#   order:       LED indices sorted along x, y and z (order[1] is bottom to top)
+#   cylindrical: (N, 3) angle (0 to 1), height (0 to 1, 1 is the top) and radius (0 to 1)
+#                around the tree axis, which goes up through the middle of the tree
+#   index:       KD-tree (or voxel grid) for the neighbour queries below
+def prepare_layout(layout):
+    xyz = layout["xyz"]
+    layout["order"] = [np.argsort(xyz[:, axis], kind="stable") for axis in range(3)]
+
+    center = xyz.mean(axis=0) if len(xyz) else np.zeros(3, dtype=np.float32)
+    dx = xyz[:, 0] - center[0]
+    dz = xyz[:, 2] - center[2]
+    radius = np.hypot(dx, dz)
+    layout["center"] = center
+    layout["cylindrical"] = np.column_stack((
+        (np.arctan2(dz, dx) / (2 * np.pi)) % 1.0,
+        layout["normalized"][:, 1],
+        radius / radius.max() if len(radius) and radius.max() > 0 else radius
+    )).astype(np.float32)
+
+    layout["index"] = build_spatial_index(xyz)
+    return layout
+
+# KD-tree from scipy, or a voxel grid with about one LED per cell
+def build_spatial_index(xyz):
+    if cKDTree is not None:
+        return {"kind": "kdtree", "tree": cKDTree(xyz)}
+
+    size = xyz.max(axis=0) - xyz.min(axis=0) if len(xyz) else np.ones(3)
+    cell = max(float(np.prod(np.maximum(size, 1e-3))) / max(len(xyz), 1), 1e-9) ** (1 / 3)
+    origin = xyz.min(axis=0) if len(xyz) else np.zeros(3)
+    cells = {}
+    for i, key in enumerate(map(tuple, np.floor((xyz - origin) / cell).astype(int))):
+        cells.setdefault(key, []).append(i)
+    return {
+        "kind": "voxels",
+        "cell": cell,
+        "origin": origin,
+        "cells": {key: np.array(value) for key, value in cells.items()}
+    }
+
+# Indices of the LEDs within radius (mm) of a point
+def neighbours_within(layout, point, radius):
+    index = layout["index"]
+    point = np.asarray(point, dtype=np.float32)
+    if index["kind"] == "kdtree":
+        return np.array(index["tree"].query_ball_point(point, radius), dtype=np.intp)
+
+    low = np.floor((point - radius - index["origin"]) / index["cell"]).astype(int)
+    high = np.floor((point + radius - index["origin"]) / index["cell"]).astype(int)
+    found = [index["cells"].get((x, y, z)) for x in range(low[0], high[0] + 1)
+             for y in range(low[1], high[1] + 1) for z in range(low[2], high[2] + 1)]
+    found = [cell for cell in found if cell is not None]
+    if not found:
+        return np.zeros(0, dtype=np.intp)
+    candidates = np.concatenate(found)
+    distance = np.linalg.norm(layout["xyz"][candidates] - point, axis=1)
+    return np.sort(candidates[distance <= radius])
+
+# The k nearest LEDs of every LED (not counting itself), as a (N, k) index array
+def nearest_neighbours(layout, k):
+    xyz = layout["xyz"]
+    k = min(k, len(xyz) - 1)
+    if k <= 0:
+        return np.zeros((len(xyz), 0), dtype=np.intp)
+    if layout["index"]["kind"] == "kdtree":
+        _, nearest = layout["index"]["tree"].query(xyz, k + 1)
+        return nearest[:, 1:].astype(np.intp)
+
+    # Without scipy, all distances in blocks so the memory use stays small
+    nearest = np.empty((len(xyz), k), dtype=np.intp)
+    for start in range(0, len(xyz), 256):
+        block = np.linalg.norm(xyz[start:start + 256, np.newaxis] - xyz[np.newaxis], axis=2)
+        block[np.arange(len(block)), np.arange(start, start + len(block))] = np.inf
+        nearest[start:start + 256] = np.argsort(block, axis=1)[:, :k]
+    return nearest
+
+# Reads led_3d_coordinates.txt ("LED ID, X, Y, Z" header and one LED per line)
+def read_coordinates_csv(path):
+    data = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+    return data[:, 0].astype(np.uint32), data[:, 1:4]
+
+# Reads a .npy file, either the 3D results from capture_plans (id, x, y, z, error)
+# or a plan (id, x, y), which gets z = 0
+def read_positions_npy(path):
+    data = np.load(path)
+    if data.dtype.names:
+        return data["id"].astype(np.uint32), np.column_stack((data["x"], data["y"], data["z"]))
+    data = data.reshape(len(data), -1)
+    ids = data[:, 0].astype(np.uint32)
+    if data.shape[1] == 3:
+        return ids, np.column_stack((data[:, 1:3], np.zeros(len(data))))
+    return ids, data[:, 1:4]
+
+# Converts led_3d_coordinates.txt or a .npy file to a layout file
+def convert_to_layout(source, destination):
+    if source.endswith(".npy"):
+        ids, xyz = read_positions_npy(source)
+    else:
+        ids, xyz = read_coordinates_csv(source)
+    write_layout(destination, ids, xyz)
+    return len(ids)
+
+# Loads the layout file, and makes it from the text file first if it is missing or older
+def load_or_convert_layout(layout_path, csv_path):
+    if os.path.exists(csv_path) and (not os.path.exists(layout_path)
+                                     or os.path.getmtime(layout_path) < os.path.getmtime(csv_path)):
+        convert_to_layout(csv_path, layout_path)
+    return load_layout(layout_path)
+
+if __name__ == "__main__":
+    # python layout.py ../data/led_3d_coordinates.txt ../data/led_layout.bin
+    if len(sys.argv) != 3:
+        print("Usage: python layout.py <led_3d_coordinates.txt or .npy> <layout.bin>")
+        sys.exit(1)
+    count = convert_to_layout(sys.argv[1], sys.argv[2])
+    print(f"Wrote {count} LEDs to {sys.argv[2]}")
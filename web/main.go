@@ -3,9 +3,12 @@ package main
 import (
 	"encoding/json"
 	"fmt"
+	"io"
 	"log"
 	"net/http"
 	"net/url"
+	"strconv"
+	"strings"
 	"sync"
 
 	"github.com/gin-gonic/gin"
@@ -18,8 +21,10 @@ var (
 			return true // Allow all connections
 		},
 	}
-	// Stores the connected Pi clients, should only be one in this case
-	clients = make(map[*websocket.Conn]bool)
+	// Stores the connected clients, the Pi and the browsers
+	// The HTTP handlers run in their own goroutines, so the map is only used with clientsMutex
+	clients      = make(map[*websocket.Conn]*Client)
+	clientsMutex sync.RWMutex
 
 	ledStates      = make(map[int]string) // map[LED_ID]Color
 	ledStatesMutex sync.RWMutex
@@ -28,12 +33,33 @@ var (
 	positionsMutex sync.RWMutex
 )
 
+// Binary LED frames
+const (
+	frameHeaderSize = 12
+	maxFrameSize    = frameHeaderSize + 3*65535
+)
+
+// A connected websocket client
+// gorilla/websocket only allows one writer at a time, so every write goes through writeMutex
+type Client struct {
+	conn       *websocket.Conn
+	writeMutex sync.Mutex
+	isPi       bool // Set when the client sends Pi messages (states, status or positions)
+}
+
 type LightCommand struct {
-	Type   string `json:"type"`
-	LED    int    `json:"led,omitempty"`
-	Color  string `json:"color"`
-	Action string `json:"action,omitempty"`
-	Name   string `json:"name,omitempty"`
+	Type       string                 `json:"type"`
+	LED        int                    `json:"led,omitempty"`
+	Color      string                 `json:"color"`
+	Action     string                 `json:"action,omitempty"`
+	Name       string                 `json:"name,omitempty"`
+	LEDs       []int                  `json:"leds,omitempty"`       // batch: the LEDs to change
+	Colors     []string               `json:"colors,omitempty"`     // batch: one color per LED
+	Frame      string                 `json:"frame,omitempty"`      // frame: 6 hex digits per LED, LED 0 first
+	Duration   float64                `json:"duration,omitempty"`   // flash and animation: seconds (0 for the Pi's default)
+	Transition string                 `json:"transition,omitempty"` // animation: "fade", "wipe" or "cut" ("" for the Pi's default)
+	Baked      bool                   `json:"baked,omitempty"`      // animation: play a pre-rendered clip of the effect
+	Params     map[string]interface{} `json:"params,omitempty"`     // animation: parameters of the baked effect
 }
 
 type AnimationCommand struct {
@@ -88,10 +114,14 @@ func handleWebSocket(c *gin.Context) {
 	}
 	defer conn.Close()
 
-	clients[conn] = true
-	defer delete(clients, conn)
+	client := &Client{conn: conn}
+	clientsMutex.Lock()
+	clients[conn] = client
+	total := len(clients)
+	clientsMutex.Unlock()
+	defer removeClient(conn)
 
-	log.Printf("New client connected. Total clients: %d\n", len(clients)) // Total clients should be 1, please don't hack me
+	log.Printf("New client connected. Total clients: %d\n", total) // Total clients should be 1 Pi and some browsers, please don't hack me
 
 	// Handle incoming messages from Pi, which are LED states
 	for {
@@ -101,27 +131,55 @@ func handleWebSocket(c *gin.Context) {
 			LED       int               `json:"led,omitempty"`
 			Color     string            `json:"color,omitempty"`
 			Positions string            `json:"positions"`
+			Seq       int               `json:"seq,omitempty"`
+			Commands  int               `json:"commands,omitempty"`
+			Success   bool              `json:"success,omitempty"`
 		}
-		err := conn.ReadJSON(&msg)
+		messageType, data, err := conn.ReadMessage()
 		if err != nil {
 			log.Printf("Error reading message: %v\n", err)
 			break
 		}
 
+		// Binary LED frames (see web/frames.py) are passed on as they are
+		if messageType == websocket.BinaryMessage {
+			forwardFrame(data, conn)
+			continue
+		}
+
+		if err := json.Unmarshal(data, &msg); err != nil {
+			log.Printf("Error parsing message: %v\n", err)
+			continue
+		}
+
+		// Only the Pi sends these, so binary frames know where to go
+		if msg.Type == "states" || msg.Type == "status" || msg.Type == "positions" {
+			markPi(conn)
+		}
+
 		switch msg.Type {
 		case "states":
 			// Broadcast LED states to all web clients
 			log.Printf("Received LED states: %+v\n", msg.States)
-			for client := range clients {
-				if client != conn { // Don't send back to sender
-					err := client.WriteJSON(msg)
-					if err != nil {
-						log.Printf("Error sending states to client: %v\n", err)
-					}
+			broadcastJSON(msg, conn) // Don't send back to sender
+		case "status":
+			// The Pi only sends the LEDs that changed since its last status, with a sequence number
+			ledStatesMutex.Lock()
+			for key, color := range msg.States {
+				if led, err := strconv.Atoi(key); err == nil {
+					ledStates[led] = color
 				}
 			}
-		case "status":
-			log.Printf("Received status from client: LED %d = %s\n", msg.LED, msg.Color)
+			ledStatesMutex.Unlock()
+			if !msg.Success {
+				log.Printf("Status %d from client: some of %d commands failed\n", msg.Seq, msg.Commands)
+			}
+
+			// Tell the Pi the status arrived, so it doesn't send those LEDs again
+			// (through the client's write lock, the HTTP handlers write to the Pi at the same time)
+			if err := client.writeJSON(map[string]interface{}{"type": "ack", "seq": msg.Seq}); err != nil {
+				log.Printf("Error sending ack to client: %v\n", err)
+			}
 
 		case "positions":
 			var positions []struct {
@@ -146,17 +204,10 @@ func handleWebSocket(c *gin.Context) {
 			positionsMutex.Unlock()
 
 			// Broadcast positions to all web clients
-			for client := range clients {
-				if client != conn {
-					err := client.WriteJSON(map[string]interface{}{
-						"type":      "positions",
-						"positions": msg.Positions,
-					})
-					if err != nil {
-						log.Printf("Error sending positions to client: %v\n", err)
-					}
-				}
-			}
+			broadcastJSON(map[string]interface{}{
+				"type":      "positions",
+				"positions": msg.Positions,
+			}, conn)
 		}
 	}
 }
@@ -249,15 +300,7 @@ func handleWeather(c *gin.Context) {
 		Name:   animationType,
 	}
 
-	for client := range clients {
-		err := client.WriteJSON(command)
-		if err != nil {
-			log.Printf("Error sending to client: %v\n", err)
-			delete(clients, client)
-			client.Close()
-			continue
-		}
-	}
+	broadcastJSON(command, nil)
 
 	c.JSON(http.StatusOK, gin.H{
 		"success":   true,
@@ -281,6 +324,10 @@ func handleLightUpdate(c *gin.Context) {
 			c.JSON(http.StatusBadRequest, gin.H{"error": "Invalid LED index"})
 			return
 		}
+		if !isHexColor(cmd.Color) {
+			c.JSON(http.StatusBadRequest, gin.H{"error": "Invalid color " + cmd.Color})
+			return
+		}
 
 		// Store the LED state
 		ledStatesMutex.Lock()
@@ -289,22 +336,69 @@ func handleLightUpdate(c *gin.Context) {
 
 	case "updateAll":
 		// Update all LEDs to the same color
+		if !isHexColor(cmd.Color) {
+			c.JSON(http.StatusBadRequest, gin.H{"error": "Invalid color " + cmd.Color})
+			return
+		}
 		ledStatesMutex.Lock()
 		for i := 0; i < 40; i++ {
 			ledStates[i] = cmd.Color
 		}
 		ledStatesMutex.Unlock()
 
-	case "animation":
-		for client := range clients {
-			err := client.WriteJSON(cmd)
-			if err != nil {
-				log.Printf("Error sending to client: %v\n", err)
-				delete(clients, client)
-				client.Close()
-				continue
+	case "batch":
+		// Many LEDs in one command, the Pi shows them all in the same frame
+		if len(cmd.LEDs) != len(cmd.Colors) {
+			c.JSON(http.StatusBadRequest, gin.H{"error": "leds and colors must have the same length"})
+			return
+		}
+		for i, led := range cmd.LEDs {
+			if led < 0 || led >= 40 {
+				c.JSON(http.StatusBadRequest, gin.H{"error": "Invalid LED index"})
+				return
+			}
+			if !isHexColor(cmd.Colors[i]) {
+				c.JSON(http.StatusBadRequest, gin.H{"error": "Invalid color " + cmd.Colors[i]})
+				return
 			}
 		}
+
+		ledStatesMutex.Lock()
+		for i, led := range cmd.LEDs {
+			ledStates[led] = "#" + strings.TrimPrefix(cmd.Colors[i], "#")
+		}
+		ledStatesMutex.Unlock()
+
+	case "frame":
+		// A whole frame as one hex string
+		if len(cmd.Frame)%6 != 0 || len(cmd.Frame)/6 > 40 || !isHexDigits(cmd.Frame) {
+			c.JSON(http.StatusBadRequest, gin.H{"error": "Invalid frame"})
+			return
+		}
+
+		ledStatesMutex.Lock()
+		for i := 0; i < len(cmd.Frame)/6; i++ {
+			ledStates[i] = "#" + cmd.Frame[i*6:i*6+6]
+		}
+		ledStatesMutex.Unlock()
+
+	case "flash":
+		// A short flash over all LEDs, the state of the LEDs doesn't change
+		if !isHexColor(cmd.Color) || cmd.Duration < 0 || cmd.Duration > 5 {
+			c.JSON(http.StatusBadRequest, gin.H{"error": "Invalid flash"})
+			return
+		}
+		broadcastJSON(cmd, nil)
+		c.JSON(http.StatusOK, gin.H{"success": true})
+		return
+
+	case "animation":
+		if cmd.Duration < 0 || cmd.Duration > 10 ||
+			(cmd.Transition != "" && cmd.Transition != "fade" && cmd.Transition != "wipe" && cmd.Transition != "cut") {
+			c.JSON(http.StatusBadRequest, gin.H{"error": "Invalid transition"})
+			return
+		}
+		broadcastJSON(cmd, nil)
 		c.JSON(http.StatusOK, gin.H{"success": true})
 		return
 
@@ -314,18 +408,114 @@ func handleLightUpdate(c *gin.Context) {
 	}
 
 	// Broadcast to all connected Pis
-	for client := range clients {
-		err := client.WriteJSON(cmd)
-		if err != nil {
+	broadcastJSON(cmd, nil)
+
+	log.Printf("Sent command to client: %+v\n", cmd)
+
+	c.JSON(http.StatusOK, gin.H{"success": true})
+}
+
+// True if s only has hex digits
+func isHexDigits(s string) bool {
+	for _, r := range s {
+		if !strings.ContainsRune("0123456789abcdefABCDEF", r) {
+			return false
+		}
+	}
+	return true
+}
+
+// True if color is 6 hex digits, with or without a # in front ("#ff0000" or "ff0000")
+func isHexColor(color string) bool {
+	digits := strings.TrimPrefix(color, "#")
+	return len(digits) == 6 && isHexDigits(digits)
+}
+
+// Writes a JSON message to the client, only one goroutine writes to a connection at a time
+func (client *Client) writeJSON(v interface{}) error {
+	client.writeMutex.Lock()
+	defer client.writeMutex.Unlock()
+	return client.conn.WriteJSON(v)
+}
+
+// Writes a binary message to the client
+func (client *Client) writeBinary(data []byte) error {
+	client.writeMutex.Lock()
+	defer client.writeMutex.Unlock()
+	return client.conn.WriteMessage(websocket.BinaryMessage, data)
+}
+
+// Removes a client from the map and closes its connection
+func removeClient(conn *websocket.Conn) {
+	clientsMutex.Lock()
+	delete(clients, conn)
+	clientsMutex.Unlock()
+	conn.Close()
+}
+
+// Remembers that a connection is the Pi
+func markPi(conn *websocket.Conn) {
+	clientsMutex.Lock()
+	if client, ok := clients[conn]; ok {
+		client.isPi = true
+	}
+	clientsMutex.Unlock()
+}
+
+// The connected clients (only the Pi with onlyPi), except one connection
+// The map is copied, so the writes happen without holding clientsMutex
+func connectedClients(except *websocket.Conn, onlyPi bool) []*Client {
+	clientsMutex.RLock()
+	defer clientsMutex.RUnlock()
+	list := make([]*Client, 0, len(clients))
+	for conn, client := range clients {
+		if conn != except && (client.isPi || !onlyPi) {
+			list = append(list, client)
+		}
+	}
+	return list
+}
+
+// Sends a JSON message to every client except one (nil to send to all of them)
+// A client that can't be written to is removed
+func broadcastJSON(v interface{}, except *websocket.Conn) {
+	for _, client := range connectedClients(except, false) {
+		if err := client.writeJSON(v); err != nil {
 			log.Printf("Error sending to client: %v\n", err)
-			delete(clients, client)
-			client.Close()
-			continue
+			removeClient(client.conn)
 		}
 	}
+}
 
-	log.Printf("Sent command to client: %+v\n", cmd)
+// Sends a binary LED frame to the Pi
+// The browsers only understand JSON messages, so they never get the frames
+// The frame is a 12 byte header ("LF", version, flags, first LED, LED count, sequence) and RGB bytes
+func forwardFrame(frame []byte, sender *websocket.Conn) bool {
+	if len(frame) < frameHeaderSize || string(frame[0:2]) != "LF" {
+		log.Printf("Invalid binary frame of %d bytes\n", len(frame))
+		return false
+	}
+
+	for _, client := range connectedClients(sender, true) {
+		if err := client.writeBinary(frame); err != nil {
+			log.Printf("Error sending frame to client: %v\n", err)
+			removeClient(client.conn)
+		}
+	}
+	return true
+}
 
+// Streams a binary LED frame to the Pi, the body is the frame as it is (application/octet-stream)
+func handleFrame(c *gin.Context) {
+	frame, err := io.ReadAll(io.LimitReader(c.Request.Body, maxFrameSize))
+	if err != nil {
+		c.JSON(http.StatusBadRequest, gin.H{"error": err.Error()})
+		return
+	}
+	if !forwardFrame(frame, nil) {
+		c.JSON(http.StatusBadRequest, gin.H{"error": "Invalid frame"})
+		return
+	}
 	c.JSON(http.StatusOK, gin.H{"success": true})
 }
 
@@ -350,6 +540,7 @@ func main() {
 	r.POST("/api/updateLights", handleLightUpdate)
 	r.GET("/api/getStates", handleGetStates)
 	r.POST("/api/weather", handleWeather)
+	r.POST("/api/frame", handleFrame)
 
 	log.Println("Server starting on port 80...")
 	r.Run(":80")
@@ -0,0 +1,129 @@
+import numpy as np
+
+# Output stage between the compositor and the strip
+# The compositor gives 0 to 1 colors (in the order the strip tuples want, GBR for our strip),
+# and this makes the bytes for the strip:
+#   1. 16-bit values through a gamma table for each channel, so fades look even to the eye
+#      (and scaled down if the frame would use more current than the power supply can give)
+#   2. temporal dithering down to 8 bits, the part below 8 bits is carried to the next frame,
+#      so dim colors flicker between two levels instead of jumping in steps
+#   3. the bytes are written straight into the strip's buffer in its byte order
+# Everything works on the whole frame at once, there is no Python code per LED
+
+# Gamma of each channel, and whether to dither by default
+default_gamma = 2.2
+default_dither = True
+
+# Current of the LEDs, for the power limiter
+# A WS2812 uses about 20 mA per channel at full brightness, and about 1 mA when it is off
+default_ma_per_unit = (20.0 / 255, 20.0 / 255, 20.0 / 255)
+default_idle_ma = 1.0
+
+# 256 entry gamma table with 16-bit values (one extra entry at the end so it can be interpolated)
+def make_gamma_lut(gamma, brightness=1.0):
+    x = np.minimum(np.arange(257) / 255.0, 1.0)
+    return np.rint(x ** gamma * brightness * 65535).astype(np.uint32)
+
+# Makes the output stage for a strip with num_pixels LEDs
+# gamma is one number or one per channel (in the same order as the colors)
+# budget_ma is how much current the power supply can give (None for no limit),
+# ma_per_unit the current of each channel per step of its 8-bit value
+def make_output(num_pixels, gamma=default_gamma, brightness=1.0, dither=default_dither,
+                budget_ma=None, ma_per_unit=default_ma_per_unit, idle_ma=default_idle_ma):
+    gammas = np.broadcast_to(np.asarray(gamma, dtype=np.float64), (3,))
+    return {
+        # Current per channel per step of the 16-bit values
+        "ma_per_unit": np.asarray(ma_per_unit, dtype=np.float64) / 256,
+        "idle_ma": idle_ma * num_pixels,
+        "budget_ma": budget_ma,
+        # current is what the strip uses after the limiter, demand what the frames asked for
+        "power": {
+            "current_ma": 0.0,
+            "peak_ma": 0.0,
+            "average_ma": 0.0,
+            "demand_ma": 0.0,
+            "peak_demand_ma": 0.0,
+            "limited_frames": 0,
+            "frames": 0
+        },
+        "luts": np.stack([make_gamma_lut(g, brightness) for g in gammas]),
+        "channels": np.arange(3),
+        "dither": dither,
+        # What was left below 8 bits in the last frame (0 to 255)
+        "error": np.zeros((num_pixels, 3), dtype=np.uint32),
+        "frame": np.zeros((num_pixels, 3), dtype=np.uint8)
+    }
+
+# Makes the 8-bit frame for the strip from a (num_pixels, 3) 0 to 1 frame
+def apply_output(output, colors):
+    value = np.rint(np.clip(colors, 0.0, 1.0) * 65535).astype(np.uint32)
+
+    # Gamma table, interpolated between the entries with the low 8 bits
+    index = value >> 8
+    fraction = value & 255
+    luts = output["luts"]
+    low = luts[output["channels"], index]
+    high = luts[output["channels"], index + 1]
+    linear = low + (((high - low) * fraction) >> 8)
+    linear = limit_power(output, linear)
+
+    if output["dither"]:
+        total = linear + output["error"]
+        frame = np.minimum(total >> 8, 255)
+        output["error"] = np.minimum(total - (frame << 8), 255)
+    else:
+        frame = np.minimum((linear + 128) >> 8, 255)
+
+    output["frame"][:] = frame
+    return output["frame"]
+
+# Scales the 16-bit frame down when it would use more current than the budget
+# The current is one sum over the frame, and the peak and average are kept in output["power"]
+# The current before the limiter is kept too (demand), so it shows how far over the budget the frames go
+def limit_power(output, linear):
+    power = output["power"]
+    demand = output["idle_ma"] + float(linear.sum(axis=0) @ output["ma_per_unit"])
+    current = demand
+
+    budget = output["budget_ma"]
+    if budget is not None and demand > budget:
+        scale = max(budget - output["idle_ma"], 0.0) / (demand - output["idle_ma"])
+        linear = (linear * scale).astype(np.uint32)
+        current = float(budget)
+        power["limited_frames"] += 1
+
+    power["frames"] += 1
+    power["demand_ma"] = demand
+    power["peak_demand_ma"] = max(power["peak_demand_ma"], demand)
+    power["current_ma"] = current
+    power["peak_ma"] = max(power["peak_ma"], current)
+    power["average_ma"] += (current - power["average_ma"]) / power["frames"]
+    return linear
+
+# The strip's byte buffer as a (LEDs, bytes per LED) array and the byte of each channel,
+# or None when the strip can't be written like that (then the normal pixels[...] = ... is used)
+# Only works for the Adafruit pixelbuf strips at full brightness (brightness is done in the gamma table)
+def strip_buffer(pixels):
+    buffer = getattr(pixels, "_post_brightness_buffer", None)
+    byteorder = getattr(pixels, "_byteorder", None)
+    bpp = getattr(pixels, "_bpp", None)
+    if (not isinstance(buffer, bytearray) or byteorder is None or bpp not in (3, 4)
+            or getattr(pixels, "_pre_brightness_buffer", None) is not None
+            or "P" in getattr(pixels, "_byteorder_string", "")):
+        return None
+    offset = getattr(pixels, "_offset", 0)
+    wire = np.frombuffer(buffer, dtype=np.uint8, count=len(pixels) * bpp, offset=offset)
+    return wire.reshape(len(pixels), bpp), np.asarray(byteorder[:3], dtype=np.intp)
+
+# Writes a frame to the strip and shows it
+def write_output(pixels, output, frame):
+    if "strip" not in output:
+        output["strip"] = strip_buffer(pixels)
+
+    if output["strip"] is not None:
+        # One step puts every channel at its byte in the strip's order (GRB, RGB, ...)
+        wire, byteorder = output["strip"]
+        wire[:len(frame), byteorder] = frame
+    else:
+        pixels[0:len(frame)] = frame.tolist()
+    pixels.show()